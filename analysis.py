@@ -1,13 +1,14 @@
-import math
 import cv2 as cv
 import numpy as np
-from collections import defaultdict
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional, Tuple, Dict
 
-from model import Color, Point, DeformType
+from model import Color, Point, DeformType, points_from_array, pixel_coords
 from image_data import ImageData, SourceType
-from processor import ImageProcessor
+from processor import ImageProcessor, CentroidEngine
+from matching import NearestMatcher
+from template import TemplateModel, RowGroups, assign_rows
+from resolution import ResolutionPolicy, ScaledResolution, DEFAULT_RESOLUTION
 
 
 @dataclass
@@ -20,6 +21,8 @@ class DistanceAggregator:
 class ProcessedDataFields:
     TEMPLATE_IMAGE = "Template"
     MUAR_IMAGE = "Muar"
+    TEMPLATE_CENTERS = "TemplateCenters"
+    MUAR_CENTERS = "MuarCenters"
     TEMPLATE_POINTS = "TemplatePoints"
     MUAR_POINTS = "MuarPoints"
     ALL_POINTS_BY_ROW = "AllPointsByRow"
@@ -29,7 +32,44 @@ class ProcessedDataFields:
 
 BY_DEFORM_MSG = {DeformType.noneDeform: "No defects",
                  DeformType.inDeform: "Concavity",
-                 DeformType.outDeform: "Bulge"}
+                 DeformType.outDeform: "Bulge",
+                 DeformType.anyDeform: "Deform"}
+
+
+def deform_type(has_deform: bool) -> DeformType:
+    """ Вид деформации для вердикта has_deform, ключ BY_DEFORM_MSG """
+    return DeformType.anyDeform if has_deform else DeformType.noneDeform
+
+
+PERSENTILE_LEVELS = (50, 90, 99)
+
+# Пороги has_deform: медиана расстояний в пикселях и отношение p99 к медиане
+DEFORM_P50_LIMIT = 4
+DEFORM_RATIO_LIMIT = 2.1
+
+
+def deform_by_persentiles(persentile50: float, persentile99: float) -> bool:
+    """ Решение о деформации по медиане и 99-му перцентилю расстояний """
+    if persentile50 > DEFORM_P50_LIMIT:
+        return True
+    if persentile50 == 0:
+        return persentile99 > 0
+    return persentile99 / persentile50 > DEFORM_RATIO_LIMIT
+
+
+def near_deform_threshold(persentile50: float, persentile99: float, margin: float = 0.25,
+                          pixel: float = 1.0) -> bool:
+    """
+    Перцентили слишком близко к порогам has_deform, чтобы доверять решению
+
+    margin: относительный запас у порогов, pixel: размер пикселя анализа в
+    пикселях растра, ошибка перцентилей порядка него
+    """
+    if persentile50 <= pixel:
+        return persentile99 <= DEFORM_RATIO_LIMIT * (1 + margin) * pixel
+    if abs(persentile50 - DEFORM_P50_LIMIT) <= max(margin * DEFORM_P50_LIMIT, pixel):
+        return True
+    return abs(persentile99 / persentile50 - DEFORM_RATIO_LIMIT) <= margin * DEFORM_RATIO_LIMIT
 
 
 class AnalizatorBaseException(Exception):
@@ -41,9 +81,26 @@ class AnalizatorAttributeError(AnalizatorBaseException):
 
 
 class Analizator:
-    """ Складывает обработанное изображение с растром и анализирует данные """
-
-    def __init__(self, base_raster: ImageData, over_raster: ImageData, processed_image: ImageData):
+    """
+    Складывает обработанное изображение с растром и анализирует данные
+
+    restrict_rows: искать ближайший центр шаблона только в строке точки муара,
+    при False поиск идет по всему изображению
+    template_model: заранее построенная модель шаблона для этой пары растров,
+    иначе строится из base_raster и over_raster
+    resolution: политика рабочего размера, в котором идет анализ. Расстояния
+    в distanses и на постере в пикселях рабочего размера, перцентили и
+    distance_values пересчитаны в пиксели растра
+    centroids: способ поиска центров пятен, MOMENTS дает дробные центры масс
+    min_blob_area, max_blob_area: пределы площади пятен муара, чтобы
+    отбросить мелкий шум, действуют в обоих способах centroids
+    """
+
+    def __init__(self, base_raster: ImageData, over_raster: ImageData, processed_image: ImageData,
+                 restrict_rows: bool = True, template_model: Optional[TemplateModel] = None,
+                 resolution: ResolutionPolicy = DEFAULT_RESOLUTION,
+                 centroids: CentroidEngine = CentroidEngine.HULL, min_blob_area: int = 0,
+                 max_blob_area: Optional[int] = None):
         if (
                 base_raster.source is not SourceType.RASTER
                 or over_raster.source is not SourceType.RASTER
@@ -56,103 +113,92 @@ class Analizator:
                 processed_image.image, 127)
         else:
             _processed_image = processed_image.image
+        width, height = resolution.size(base_raster.shape())
         _processed_image = ImageProcessor.resize(
-            _processed_image, 1000, 1000, interpolation=cv.INTER_AREA)
+            _processed_image, width, height, interpolation=cv.INTER_AREA)
         self._base_raster = base_raster
         self._over_raster = over_raster
+        self._restrict_rows = restrict_rows
+        # Рабочий размер может менять пропорции растра, поэтому масштаб по осям свой
+        self.scale_x = width / base_raster.shape()[1]
+        self.scale_y = height / base_raster.shape()[0]
+        self.scale = min(self.scale_x, self.scale_y)
+        self._centroids = centroids
+        self._blob_area = (min_blob_area, max_blob_area)
+        if (
+                template_model is None
+                or template_model.shape != (height, width)
+                or template_model.centroids is not centroids
+        ):
+            template_model = TemplateModel.build(base_raster, over_raster, (width, height), centroids)
+        self._template = template_model
         self._processed_image = ImageData(
             _processed_image, SourceType.PROCESSED)
         self.processed_data = {}
         self._process()
 
     def _row_border_coord_template(self):
-        t_points = self.template_points
-        y_points = [point.coy for point in t_points]
-        y_points = sorted(list(set(y_points)))
-        h_half = (y_points[1] - y_points[0]) / 2
-        ranges = [(i, [y_co - h_half, y_co + h_half])
-                  for i, y_co in enumerate(y_points, start=1)]
-        return ranges
-
-    def _set_points_into_near_row(self):
-        muar_rows = []
-        template_ranges = self._row_border_coord_template()
-        m_points = self.muar_points
-        for row in template_ranges:
-            for point in m_points:
-                if point.coy >= row[1][0] and not point.coy >= row[1][1]:
-                    muar_rows.append((row[0], point))
-        template_rows = []
-        t_points = self.template_points
-        for row in template_ranges:
-            for point in t_points:
-                if point.coy >= row[1][0] and not point.coy >= row[1][1]:
-                    template_rows.append((row[0], point))
-        return template_rows, muar_rows
+        return self._template.row_ranges
 
     def _sort_points_by_rows(self):
-        self._set_points_into_near_row()
-        t_points_rows_sorted, m_points_rows_sorted = self._set_points_into_near_row()
-        t_points_by_rows = defaultdict(list)
-        m_points_by_rows = defaultdict(list)
-        for t_point in t_points_rows_sorted:
-            t_points_by_rows[t_point[0]].append(t_point[1])
-        for m_point in m_points_rows_sorted:
-            m_points_by_rows[m_point[0]].append(m_point[1])
+        m_points_by_rows = assign_rows(self._row_border_coord_template(), self.muar_centers[:, 1])
         self.processed_data[ProcessedDataFields.ALL_POINTS_BY_ROW] = {
-            "T": t_points_by_rows, "M": m_points_by_rows}
-
-    def _row_distance_aggregate(self, template_row_points: List[Point], muar_row_points: List[Point]):
-        muar_to_template_dist_aggregates = []
-        for mrp in muar_row_points:
-            min_dist = math.inf
-            t_point = None
-            for trp in template_row_points:
-                dist = math.dist(mrp.to_tuple(), trp.to_tuple())
-                if dist < min_dist:
-                    min_dist = dist
-                    t_point = trp
-            if t_point:
-                muar_to_template_dist_aggregates.append(
-                    DistanceAggregator(mrp, t_point, min_dist))
-        return muar_to_template_dist_aggregates
+            "T": self._template.row_groups, "M": m_points_by_rows}
+
+    def _row_distance_aggregate(self, matcher: NearestMatcher, template_indexes: np.ndarray,
+                                muar_indexes: np.ndarray):
+        if not len(matcher) or not len(muar_indexes):
+            return []
+        indexes, distances = matcher.query(self.muar_centers[muar_indexes])
+        template_points = self.template_points
+        muar_points = self.muar_points
+        return [DistanceAggregator(muar_points[muar_index], template_points[template_index], distance)
+                for muar_index, template_index, distance
+                in zip(muar_indexes.tolist(), template_indexes[indexes].tolist(), distances.tolist())]
 
     def _point_distance_analysis(self):
+        if not self._restrict_rows:
+            all_indexes = np.arange(len(self.template_centers))
+            self.processed_data[ProcessedDataFields.MIN_DISTANCES] = self._row_distance_aggregate(
+                self._template.matcher, all_indexes, np.arange(len(self.muar_centers)))
+            return
+
         distance_aggregators = []
-        template_points_by_row: dict = self.processed_data[ProcessedDataFields.ALL_POINTS_BY_ROW]["T"]
-        muar_points_by_row: dict = self.processed_data[ProcessedDataFields.ALL_POINTS_BY_ROW]["M"]
-        selected_rows_count = min(
-            [max(list(template_points_by_row.keys())), max(list(muar_points_by_row.keys()))])
+        template_points_by_row: RowGroups = self.processed_data[ProcessedDataFields.ALL_POINTS_BY_ROW]["T"]
+        muar_points_by_row: RowGroups = self.processed_data[ProcessedDataFields.ALL_POINTS_BY_ROW]["M"]
+        selected_rows_count = min(template_points_by_row.max_row, muar_points_by_row.max_row)
         for i in range(selected_rows_count):
             distance_aggregators.extend(self._row_distance_aggregate(
-                template_points_by_row[i], muar_points_by_row[i]))
+                self._template.row_matcher(i), template_points_by_row[i], muar_points_by_row[i]))
 
         self.processed_data[ProcessedDataFields.MIN_DISTANCES] = distance_aggregators
 
     def _calc_persentiles(self):
-        distance_aggregators = self.processed_data[ProcessedDataFields.MIN_DISTANCES]
-        distances = [dist_agg.distance for dist_agg in distance_aggregators]
-        persent50 = np.percentile(distances, 50)
-        persent90 = np.percentile(distances, 90)
-        persent99 = np.percentile(distances, 99)
+        persent50, persent90, persent99 = np.percentile(self.distance_values, PERSENTILE_LEVELS)
         self.processed_data[ProcessedDataFields.PERSENTILES] = (
             persent50, persent90, persent99)
 
-    def _process(self):
-        template = ImageProcessor.masking(
-            self._base_raster.image, self._over_raster.image)
+    def _extract_muar(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Изображение муара под маской и центры его пятен """
         muar = ImageProcessor.masking(
-            self._processed_image.image, self._over_raster.image)
-        self.processed_data[ProcessedDataFields.TEMPLATE_IMAGE] = template
+            self._processed_image.image, self._template.mask)
+        return muar, ImageProcessor.blob_centers(muar, self._centroids, *self._blob_area)
+
+    def _process(self):
+        muar, m_centers = self._extract_muar()
+        self.processed_data[ProcessedDataFields.TEMPLATE_IMAGE] = self._template.template_image
         self.processed_data[ProcessedDataFields.MUAR_IMAGE] = muar
-        t_points = ImageProcessor.hull_points(template).centers
-        m_points = ImageProcessor.hull_points(muar).centers
-        self.processed_data[ProcessedDataFields.TEMPLATE_POINTS] = t_points
-        self.processed_data[ProcessedDataFields.MUAR_POINTS] = m_points
+        self.processed_data[ProcessedDataFields.TEMPLATE_CENTERS] = self._template.centers
+        self.processed_data[ProcessedDataFields.TEMPLATE_POINTS] = self._template.points
+        self.processed_data[ProcessedDataFields.MUAR_CENTERS] = m_centers
         self._sort_points_by_rows()
         self._point_distance_analysis()
         self._calc_persentiles()
 
+    @property
+    def template_model(self) -> TemplateModel:
+        return self._template
+
     @property
     def template_image(self):
         return self.processed_data[ProcessedDataFields.TEMPLATE_IMAGE]
@@ -161,55 +207,100 @@ class Analizator:
     def muar_image(self):
         return self.processed_data[ProcessedDataFields.MUAR_IMAGE]
 
+    @property
+    def template_centers(self) -> np.ndarray:
+        return self.processed_data[ProcessedDataFields.TEMPLATE_CENTERS]
+
+    @property
+    def muar_centers(self) -> np.ndarray:
+        return self.processed_data[ProcessedDataFields.MUAR_CENTERS]
+
+    def _points_view(self, points_field: str, centers_field: str) -> List[Point]:
+        if points_field not in self.processed_data:
+            self.processed_data[points_field] = points_from_array(self.processed_data[centers_field])
+        return self.processed_data[points_field]
+
     @property
     def template_points(self) -> List[Point]:
-        return self.processed_data[ProcessedDataFields.TEMPLATE_POINTS]
+        return self._points_view(ProcessedDataFields.TEMPLATE_POINTS, ProcessedDataFields.TEMPLATE_CENTERS)
 
     @property
     def muar_points(self) -> List[Point]:
-        return self.processed_data[ProcessedDataFields.MUAR_POINTS]
+        return self._points_view(ProcessedDataFields.MUAR_POINTS, ProcessedDataFields.MUAR_CENTERS)
 
     @property
     def distanses(self):
         return self.processed_data[ProcessedDataFields.MIN_DISTANCES]
 
+    @property
+    def distance_values(self) -> np.ndarray:
+        if self.scale_x == self.scale_y:
+            distances = np.array([dist_agg.distance for dist_agg in self.distanses], dtype=np.float64)
+            return distances / self.scale
+        shifts = np.array([(dist_agg.muar_point.cox - dist_agg.template_point.cox,
+                            dist_agg.muar_point.coy - dist_agg.template_point.coy)
+                           for dist_agg in self.distanses], dtype=np.float64).reshape(-1, 2)
+        return np.hypot(shifts[:, 0] / self.scale_x, shifts[:, 1] / self.scale_y)
+
     @property
     def persentiles(self):
         return self.processed_data[ProcessedDataFields.PERSENTILES]
 
     def has_deform(self):
         persentiles = self.processed_data[ProcessedDataFields.PERSENTILES]
-        persentiles50 = persentiles[0]
-        persentiles99 = persentiles[2]
-        if persentiles50 > 4:
-            return True
-        if persentiles99 / persentiles50 > 2.1:
-            return True
-        return False
+        return deform_by_persentiles(persentiles[0], persentiles[2])
 
     def _poster_select_great_heights(self, poster: np.ndarray):
         color = Color.Yellow
+        # p90 в пикселях растра, поэтому сравнивается с distance_values, а не с distance
         select_on = self.processed_data[ProcessedDataFields.PERSENTILES][1]
-        for dist_aggregate in self.processed_data[ProcessedDataFields.MIN_DISTANCES]:
+        distances = self.distance_values
+        for dist_aggregate, distance in zip(self.processed_data[ProcessedDataFields.MIN_DISTANCES], distances):
             dist_aggregate: DistanceAggregator
-            if dist_aggregate.distance >= select_on:
-                point1 = dist_aggregate.muar_point.to_tuple()
-                point2 = dist_aggregate.template_point.to_tuple()
+            if distance >= select_on:
+                point1 = dist_aggregate.muar_point.to_pixel()
+                point2 = dist_aggregate.template_point.to_pixel()
                 cv.line(poster, point1, point2, color, 1)
 
     def poster(self, select_persentile90=True):
         poster_shape = self._processed_image.shape()
         poster_shape = (poster_shape[0], poster_shape[1], 3)
         poster = np.zeros(poster_shape, dtype='uint8')
-        t_hull_group = self.template_points
-        m_hull_group = self.muar_points
         t_color = Color.Green
         m_color = Color.Red
-        for t_point in t_hull_group:
-            cv.circle(poster, t_point.to_tuple(), 1, t_color, -1)
-        for m_point in m_hull_group:
-            cv.circle(poster, m_point.to_tuple(), 1, m_color, -1)
+        for t_point in pixel_coords(self.template_centers).tolist():
+            cv.circle(poster, t_point, 1, t_color, -1)
+        for m_point in pixel_coords(self.muar_centers).tolist():
+            cv.circle(poster, m_point, 1, m_color, -1)
         if select_persentile90:
             self._poster_select_great_heights(poster)
 
         return poster
+
+
+def coarse_to_fine(base_raster: ImageData, over_raster: ImageData, processed_image: ImageData,
+                   resolution: ResolutionPolicy = DEFAULT_RESOLUTION, coarse_factor: float = 0.5,
+                   margin: float = 0.25, template_models: Optional[Dict[Tuple[int, int], TemplateModel]] = None,
+                   **analizator_args) -> Analizator:
+    """
+    Быстрый проход в уменьшенном в coarse_factor раз размере, полный размер
+    resolution - только если грубые перцентили близко к порогам has_deform
+
+    template_models: кэш моделей шаблона по рабочему размеру (высота, ширина),
+    заполняется по ходу, чтобы модели строились один раз на партию
+    """
+    template_models = {} if template_models is None else template_models
+
+    def run(policy: ResolutionPolicy) -> Analizator:
+        width, height = policy.size(base_raster.shape())
+        analizator = Analizator(base_raster, over_raster, processed_image,
+                                template_model=template_models.get((height, width)),
+                                resolution=policy, **analizator_args)
+        template_models[(height, width)] = analizator.template_model
+        return analizator
+
+    coarse = run(ScaledResolution(resolution, coarse_factor))
+    persentile50, _, persentile99 = coarse.persentiles
+    if not near_deform_threshold(persentile50, persentile99, margin, pixel=1 / coarse.scale):
+        return coarse
+    return run(resolution)
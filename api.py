@@ -1,17 +1,23 @@
-from scipy import ndimage
 import cv2 as cv
 import numpy as np
 import dataclasses
 from typing import Optional, List
-from model import Color, Point
+from model import Color, pixel_coords
 from image_data import ImageData, SourceType
-from paths import get_config_path_data, save_config_path_data, save_raster, save_camera
+from paths import (get_config_path_data, save_config_path_data, save_raster, save_camera, save_data, save_template,
+                   flush_saves, SavedPaths, read_image)
 from settings import WindowSettings, RasterSettings, CameraSettings
-from camera import AsyncCamera
-from factory import RasterFactory
-from processor import ImageProcessor
+from camera import AsyncCamera, CameraSession, FakeCapture
+from factory import RasterCache, RasterRenderer, AnalyticRasterFactory, RENDERERS
+from processor import ImageProcessor, CentroidEngine
+from resolution import ResolutionPolicy, DEFAULT_RESOLUTION
+from blur import BlurEngine, gaussian_blur
+from template import TemplateModel
+from thresholding import ThresholdMode, ThresholdSelector
 
-_camera = None
+_session: Optional[CameraSession] = None
+_raster_cache = RasterCache()
+_threshold_selector = ThresholdSelector()
 
 
 def gaussian_blur_numpy(image, ksize=(9, 9), sigma=0):
@@ -26,6 +32,8 @@ def gaussian_blur_numpy(image, ksize=(9, 9), sigma=0):
     Returns:
     ndarray - Blurred image
     """
+    from scipy import ndimage
+
     # Calculate sigma if not provided
     if sigma == 0:
         sigma = 0.3*((ksize[0]-1)*0.5 - 1) + 0.8
@@ -69,7 +77,7 @@ def window_settings(width: int = Optional[None], height: Optional[int] = None) -
     return WindowSettings()
 
 
-def raster_settings(angle: int, distance: int, thickness: int, offset: Optional[int] = 0) -> RasterSettings:
+def raster_settings(angle: int, distance: int, thickness: int, offset: Optional[float] = 0) -> RasterSettings:
     """ Настройки растра """
     while angle < 0:
         angle += 360
@@ -106,7 +114,7 @@ def load_image_by_tag(path: str, tag: str) -> Optional[ImageData]:
 def load_raster_image(path: str) -> Optional[ImageData]:
     """ Загрузка изображения растра из указанной директории """
     try:
-        img = cv.imread(path, cv.COLOR_BGR2GRAY)
+        img = read_image(path, cv.COLOR_BGR2GRAY)
     except FileNotFoundError or FileExistsError as e:
         print(f"[!] Ошибка загрузки файла -> {e}")
         return None
@@ -116,7 +124,7 @@ def load_raster_image(path: str) -> Optional[ImageData]:
 def load_camera_image(path: str) -> Optional[ImageData]:
     """ Загрузка изображения муара из указанной директории """
     try:
-        img = cv.imread(path)
+        img = read_image(path)
     except FileNotFoundError or FileExistsError as e:
         print(f"[!] Ошибка загрузки файла -> {e}")
         return None
@@ -126,78 +134,165 @@ def load_camera_image(path: str) -> Optional[ImageData]:
 def load_processed_camera_image(path: str):
     """ Загрузка изображения муара из указанной директории """
     try:
-        img = cv.imread(path, cv.COLOR_BGR2GRAY)
+        img = read_image(path, cv.COLOR_BGR2GRAY)
     except FileNotFoundError or FileExistsError as e:
         print(f"[!] Ошибка загрузки файла -> {e}")
         return None
     return ImageData(img, SourceType.PROCESSED)
 
 
-def save_raster_image(image: np.ndarray) -> List[str]:
+def save_raster_image(image: np.ndarray) -> SavedPaths:
     return save_raster(image)
 
 
-def save_camera_image(image: np.ndarray) -> List[str]:
+def save_camera_image(image: np.ndarray) -> SavedPaths:
+    """ Пути возвращаются сразу, снимок пишется на диск в фоне """
     return save_camera(image)
 
 
-def create_raster(window_settings_: WindowSettings, raster_settings_: RasterSettings, use_save: bool) -> ImageData:
-    """ Выдача растра с указанными настройками """
-    with RasterFactory(window_settings_, raster_settings_, use_save=use_save) as factory:
-        raster = factory.process()
-        result = raster.copy()
+def wait_saved(timeout: Optional[float] = None) -> bool:
+    """ Дождаться записи всех сохраняемых файлов """
+    return flush_saves(timeout)
+
+
+def build_template_model(base: ImageData, over: ImageData, resolution: ResolutionPolicy = DEFAULT_RESOLUTION,
+                         centroids: CentroidEngine = CentroidEngine.HULL) -> TemplateModel:
+    """
+    Модель шаблона для пары растров, общая для всех снимков партии
+
+    resolution и centroids должны совпадать с переданными в Analizator,
+    иначе он не примет модель и построит свою
+    """
+    if base.source is not SourceType.RASTER or over.source is not SourceType.RASTER:
+        raise AttributeError(f"[!] Переданы неправильные источники изображения {base.source} {over.source}")
+    return TemplateModel.build(base, over, resolution.size(base.shape()), centroids)
+
+
+def save_raster_data(raster: ImageData, raster_settings_: RasterSettings) -> SavedPaths:
+    """ Растр и его настройки, пути возвращаются сразу, запись идет в фоне """
+    return save_data(raster.image, raster_settings_.stringify())
+
+
+def save_template_model(model: TemplateModel, raster_paths: SavedPaths) -> SavedPaths:
+    """ Модель шаблона с той же датой в имени, что и сохраненный растр raster_paths """
+    return save_template(model.save, raster_paths)
+
+
+def load_template_model(path: str) -> Optional[TemplateModel]:
+    """ Загрузка модели шаблона (.npz) из указанной директории """
+    try:
+        return TemplateModel.load(path)
+    except FileNotFoundError or FileExistsError as e:
+        print(f"[!] Ошибка загрузки файла -> {e}")
+        return None
+
+
+def create_raster(window_settings_: WindowSettings, raster_settings_: RasterSettings, use_save: bool,
+                  renderer: RasterRenderer = RasterRenderer.LINES, antialias: bool = False) -> ImageData:
+    """
+    Выдача растра с указанными настройками, повторные запросы берутся из кэша только для чтения
 
-    return ImageData(result, SourceType.RASTER)
+    renderer: LINES рисует полосы через cv.line, ANALYTIC вычисляет их по координатам пикселей
+    antialias: сглаживание краев полос, только для ANALYTIC
+    """
+    antialias = antialias and renderer is RasterRenderer.ANALYTIC
+    key = RasterCache.key(window_settings_, raster_settings_, renderer, antialias)
+    raster = _raster_cache.get(key)
+    if raster is None:
+        factory_type = RENDERERS[renderer]
+        factory_args = {"antialias": antialias} if factory_type is AnalyticRasterFactory else {}
+        with factory_type(window_settings_, raster_settings_, use_save=False, **factory_args) as factory:
+            raster = _raster_cache.put(key, factory.process())
+    if use_save:
+        save_data(raster, raster_settings_.stringify())
+
+    return ImageData(raster, SourceType.RASTER)
+
+
+def camera_session(camera_settings_: Optional[CameraSettings] = None, src=0, warmup_frames: int = 5,
+                   idle_timeout: Optional[float] = 60.0, fake_source: Optional[str] = None) -> CameraSession:
+    """
+    Настройка долгоживущей сессии камеры, предыдущая сессия закрывается
+
+    fake_source: видеофайл или папка с изображениями вместо устройства
+    """
+    global _session
+    close_camera()
+    capture_factory = (lambda: FakeCapture(fake_source)) if fake_source else None
+    _session = CameraSession(camera_settings_, src=src, warmup_frames=warmup_frames,
+                             idle_timeout=idle_timeout, capture_factory=capture_factory)
+    return _session
+
+
+def get_camera_session() -> CameraSession:
+    global _session
+    if _session is None:
+        _session = CameraSession()
+    return _session
 
 
 def camera(camera_settings_: Optional[CameraSettings] = None) -> Optional[AsyncCamera]:
     """ Включение, выключение камеры """
-    global _camera
-    if not _camera:
-        camera_settings_ = camera_settings_ or CameraSettings()
-        _camera = AsyncCamera(camera_settings=camera_settings_)
-        _camera.start()
-        return _camera
-    _camera.stop()
-    _camera = None
+    session = get_camera_session()
+    if not session.is_open:
+        if camera_settings_:
+            session.camera_settings = camera_settings_
+        return session.open()
+    session.close()
     return None
 
 
+def close_camera() -> None:
+    if _session is not None:
+        _session.close()
+
+
 def is_camera_on() -> bool:
-    global _camera
-    return bool(camera)
+    return _session is not None and _session.is_open
 
 
-def get_picture() -> ImageData:
-    """ Получение изображения со включенной камеры """
-    global _camera
-    if not _camera:
-        raise AttributeError("[!] Нет объекта камеры")
-    if not _camera.processing:
-        raise ValueError("[!] Камера выключена")
+def get_picture(fresh: bool = False) -> ImageData:
+    """ Получение изображения с камеры, камера открывается при необходимости и остается включенной """
     try:
-        _, img = _camera.read()
+        img = get_camera_session().get_picture(fresh=fresh)
     except Exception as e:
         raise Exception(f"[!] Ошибка чтения фотографии -> {e}")
     return ImageData(img, SourceType.RAW)
 
 
 def processor_pipeline(image_data: ImageData, threshold_value: int, top_offset: int,
-                       win_settings: WindowSettings) -> ImageData:
-    """ Основной шаблон обработки фото растра """
+                       win_settings: WindowSettings, coarse_factor: int = 1,
+                       threshold_mode: ThresholdMode = ThresholdMode.MANUAL) -> ImageData:
+    """
+    Основной шаблон обработки фото растра
+
+    threshold_mode: в автоматических режимах threshold_value не используется,
+    выбранный порог возвращает last_threshold
+    """
     if image_data.source is not SourceType.RAW:
         raise AttributeError(
             f"[!] Передан неправильный тип изображения {image_data.source}")
     image = image_data.image
     if image.ndim == 2:
         return image
-    image = ImageProcessor.threshold(image, on_value=threshold_value)
-    image = ImageProcessor.crop(image, top_crop=top_offset)
+    _threshold_selector.mode = threshold_mode
+    image = _threshold_selector.apply(ImageProcessor.gray(image), threshold_value)
+    image = ImageProcessor.crop(image, top_crop=top_offset, coarse_factor=coarse_factor)
     image = ImageProcessor.resize(
         image, width=win_settings.width, height=win_settings.height)
     return ImageData(image, SourceType.PROCESSED)
 
 
+def last_threshold() -> int:
+    """ Порог, выбранный processor_pipeline на последнем снимке """
+    return _threshold_selector.value
+
+
+def reset_threshold() -> None:
+    """ Забыть порог предыдущих снимков: CACHED пересчитает его на следующем """
+    _threshold_selector.reset()
+
+
 def processor_resize(image_data: ImageData, win_settings: WindowSettings) -> ImageData:
     image = ImageProcessor.resize(image_data.image, win_settings.width, win_settings.height,
                                   interpolation=cv.INTER_NEAREST)
@@ -237,30 +332,34 @@ def masking(base: ImageData, mask: ImageData) -> ImageData:
     return ImageData(masked, SourceType.PROCESSED)
 
 
-def smooth(image: ImageData):
-    smoothed = gaussian_blur_numpy(image.image, ksize=(9, 9))
+def smooth(image: ImageData, ksize=(9, 9), sigma: float = 0, engine: BlurEngine = BlurEngine.AUTO):
+    smoothed = gaussian_blur(image.image, ksize=ksize, sigma=sigma, engine=engine)
     return ImageData(smoothed, SourceType.PROCESSED)
 
 
 def poster_points(image_data: ImageData, poster_data: Optional[ImageData],
-                  edges: bool = False, radius: int = 2, color: Color = Color.Red) -> ImageData:
-    """ Выделить группы и отметить их центры """
+                  edges: bool = False, radius: int = 2, color: Color = Color.Red,
+                  min_area: int = 0, max_area: Optional[int] = None) -> ImageData:
+    """ Выделить группы и отметить их центры, оболочки считаются только для edges """
     image = image_data.image
     poster_shape = (image.shape[0], image.shape[1], 3)
     poster = poster_data.image if poster_data and poster_data.image is not None else None
     if poster is None:
         poster = np.zeros(poster_shape, dtype='uint8')
-    hull_group = ImageProcessor.hull_points(image)
+    blobs = ImageProcessor.blob_set(image, min_area, max_area)
+    points = pixel_coords(blobs.centers_array)
     if edges:
-        points = hull_group.hulls + hull_group.centers
-    else:
-        points = hull_group.centers
-    points: List[Point] = points
-    for point in points:
-        cv.circle(poster, point.to_tuple(), radius, color, -1)
+        points = np.concatenate((blobs.hulls_array, points))
+    for point in points.tolist():
+        cv.circle(poster, point, radius, color, -1)
     return ImageData(poster, SourceType.NONE)
 
 
+def texture_data(image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Плоский буфер RGBA float32 для текстур DearPyGui, при out - на месте """
+    return ImageProcessor.rgba_texture(image, out)
+
+
 def imshow(img: np.ndarray, winname=None) -> None:
     """ Синхронный вывод изображения с названием окна winname """
     if img is None:
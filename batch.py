@@ -0,0 +1,207 @@
+import sys
+import csv
+import json
+import glob
+import argparse
+from pathlib import Path
+from functools import partial
+from typing import List, Optional, Iterable
+from concurrent.futures import ProcessPoolExecutor
+
+import api
+from analysis import Analizator
+from resolution import DEFAULT_RESOLUTION
+from camera import IMAGE_EXTENSIONS
+from image_data import ImageData, SourceType
+from paths import IMAGE_EXTENSIONS as SAVED_EXTENSIONS
+from session import SESSION_EXTENSION, SessionReader, frame_key, split_frame_key
+from settings import WindowSettings
+from stats import DistanceStatistics
+from thresholding import ThresholdMode
+
+RECORD_FIELDS = ["path", "p50", "p90", "p99", "has_deform", "threshold", "error"]
+
+# Растры и модель шаблона загружаются один раз на процесс в _init_worker
+_rasters = {}
+# Сессии открываются в процессе при первом обращении к их кадрам
+_sessions = {}
+
+
+def _init_worker(base_path: str, over_path: str, template_path: Optional[str] = None) -> None:
+    for key, path in (("base", base_path), ("over", over_path)):
+        raster = api.load_raster_image(path)
+        if raster is None or raster.image is None:
+            raise FileNotFoundError(f"[!] Не удалось загрузить растр {path}")
+        _rasters[key] = raster
+    template = api.load_template_model(template_path) if template_path else None
+    if template is not None and template.size != DEFAULT_RESOLUTION.size(_rasters["base"].shape()):
+        print(f"[!] Модель шаблона {template_path} построена для размера {template.size}, строится заново",
+              file=sys.stderr)
+        template = None
+    _rasters["template"] = template or api.build_template_model(_rasters["base"], _rasters["over"],
+                                                                DEFAULT_RESOLUTION)
+
+
+def _session(path: str) -> SessionReader:
+    if path not in _sessions:
+        _sessions[path] = SessionReader(path)
+    return _sessions[path]
+
+
+def _session_inputs(path: str) -> List[str]:
+    return [frame_key(path, index) for index in _session(path).captures()]
+
+
+def collect_inputs(patterns: Iterable[str]) -> List[str]:
+    """
+    Папки раскрываются в список изображений, файлы сессий - в снимки камеры
+    из них (путь#номер), остальное трактуется как glob
+    """
+    paths = []
+    for pattern in patterns:
+        if Path(pattern).is_dir():
+            paths.extend(str(path) for path in sorted(Path(pattern).iterdir())
+                         if path.suffix.lower() in IMAGE_EXTENSIONS + SAVED_EXTENSIONS)
+            continue
+        for path in sorted(glob.glob(pattern)):
+            if Path(path).suffix.lower() == SESSION_EXTENSION:
+                paths.extend(_session_inputs(path))
+            else:
+                paths.append(path)
+    return paths
+
+
+def _load_capture(path: str, raw: bool) -> ImageData:
+    """ Снимок из файла или кадр сессии без копирования, источник кадра сессии берется из ее индекса """
+    frame = split_frame_key(path)
+    if frame is not None:
+        return _session(frame[0]).image_data(frame[1])
+    image = api.load_camera_image(path) if raw else api.load_processed_camera_image(path)
+    if image is None or image.image is None:
+        raise ValueError(f"cannot read {path}")
+    return image
+
+
+def analyse_capture(path: str, raw: bool = False, threshold: int = 100, top_offset: int = 16,
+                    threshold_mode: ThresholdMode = ThresholdMode.MANUAL) -> dict:
+    """ Анализ одного снимка растрами текущего процесса """
+    chosen = None
+    try:
+        image = _load_capture(path, raw)
+        if image.source is SourceType.RAW:
+            # Снимки достаются процессам в произвольном порядке, поэтому порог
+            # CACHED не переносится между снимками и результат не зависит от раздачи
+            api.reset_threshold()
+            height, width = _rasters["base"].shape()[:2]
+            image = api.processor_pipeline(image, threshold, top_offset,
+                                           WindowSettings(width, height), threshold_mode=threshold_mode)
+            chosen = api.last_threshold()
+        analizator = Analizator(_rasters["base"], _rasters["over"], image, template_model=_rasters["template"],
+                                resolution=DEFAULT_RESOLUTION)
+        p50, p90, p99 = analizator.persentiles
+        statistics = DistanceStatistics()
+        statistics.add(analizator.distance_values)
+        return {"path": path, "p50": float(p50), "p90": float(p90), "p99": float(p99),
+                "has_deform": bool(analizator.has_deform()), "threshold": chosen, "error": None,
+                "statistics": statistics}
+    except Exception as e:
+        return {"path": path, "p50": None, "p90": None, "p99": None, "has_deform": None, "threshold": chosen,
+                "error": str(e)}
+
+
+class _JsonlWriter:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, record: dict) -> None:
+        self._stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._stream.flush()
+
+
+class _CsvWriter:
+    def __init__(self, stream):
+        self._stream = stream
+        self._writer = csv.DictWriter(stream, fieldnames=RECORD_FIELDS)
+        self._writer.writeheader()
+
+    def write(self, record: dict) -> None:
+        self._writer.writerow(record)
+        self._stream.flush()
+
+
+WRITERS = {"jsonl": _JsonlWriter, "csv": _CsvWriter}
+
+
+def run(base: str, over: str, paths: List[str], writer, raw: bool = False, threshold: int = 100,
+        top_offset: int = 16, workers: Optional[int] = None, chunksize: int = 4,
+        template: Optional[str] = None, summary: Optional[DistanceStatistics] = None,
+        threshold_mode: ThresholdMode = ThresholdMode.MANUAL) -> int:
+    """
+    Раздает снимки по процессам и пишет результаты в порядке входных снимков, возвращает число ошибок
+
+    summary: сюда объединяется статистика расстояний всех снимков
+    """
+    errors = 0
+    task = partial(analyse_capture, raw=raw, threshold=threshold, top_offset=top_offset,
+                   threshold_mode=threshold_mode)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(base, over, template)) as pool:
+        for record in pool.map(task, paths, chunksize=chunksize):
+            statistics = record.pop("statistics", None)
+            if summary is not None and statistics is not None:
+                summary.merge(statistics)
+            errors += record["error"] is not None
+            writer.write(record)
+    return errors
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Пакетный анализ снимков муара без интерфейса")
+    parser.add_argument("base", help="базовый растр")
+    parser.add_argument("over", help="накладываемый растр")
+    parser.add_argument("inputs", nargs="+", help=f"папки, glob-шаблоны снимков или сессии {SESSION_EXTENSION}")
+    parser.add_argument("--template", help="модель шаблона .npz для этой пары растров")
+    parser.add_argument("--raw", action="store_true", help="снимки необработанные, прогнать через processor_pipeline "
+                                                           "(у кадров сессий это известно из индекса)")
+    parser.add_argument("--threshold", type=int, default=100, help="порог бинаризации для --raw")
+    parser.add_argument("--threshold-mode", choices=[mode.value for mode in ThresholdMode],
+                        default=ThresholdMode.MANUAL.value,
+                        help="выбор порога для --raw, cached считает порог заново на каждом снимке")
+    parser.add_argument("--top-offset", type=int, default=16, help="обрезка сверху для --raw")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="jsonl")
+    parser.add_argument("--output", help="файл результатов, по умолчанию stdout")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов, по умолчанию все ядра")
+    parser.add_argument("--chunksize", type=int, default=4)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    paths = collect_inputs(args.inputs)
+    if not paths:
+        print("[!] Не найдено ни одного снимка", file=sys.stderr)
+        return 1
+
+    summary = DistanceStatistics()
+    stream = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        errors = run(args.base, args.over, paths, WRITERS[args.format](stream), raw=args.raw,
+                     threshold=args.threshold, top_offset=args.top_offset,
+                     workers=args.workers, chunksize=args.chunksize, template=args.template,
+                     summary=summary, threshold_mode=ThresholdMode(args.threshold_mode))
+    finally:
+        if args.output:
+            stream.close()
+    persentiles = summary.persentiles()
+    if persentiles is not None:
+        p50, p90, p99 = persentiles
+        print(f"Всего снимков {summary.frames}: p50={p50:.3f} p90={p90:.3f} p99={p99:.3f} "
+              f"has_deform={summary.has_deform()}", file=sys.stderr)
+    if errors:
+        print(f"[!] Снимков с ошибками: {errors} из {len(paths)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import os
+import sys
+import timeit
+import tempfile
+import cv2 as cv
+import numpy as np
+
+import api
+from analysis import Analizator
+from blur import BlurEngine, gaussian_blur
+from image_data import ImageData, SourceType
+from processor import ImageProcessor
+from pipeline import FramePipeline
+from settings import WindowSettings
+from tiling import TiledAnalizator
+from resolution import FixedResolution
+from model import GroupPack
+from paths import Codec, write_image, read_image
+from session import SessionWriter, SessionReader
+
+
+def _measure(func, repeat: int) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def _report(name: str, **timings: float) -> None:
+    base_name, base_time = next(iter(timings.items()))
+    parts = [f"{key}={value * 1000:.2f}ms (x{base_time / value:.1f})" for key, value in timings.items()]
+    print(f"[{name}] " + ", ".join(parts) + f"; базовый вариант: {base_name}")
+
+
+def _legacy_poster_to_dpg(poster: np.ndarray) -> list:
+    """ Прежний попиксельный конвертер TextureInstrument._process_poster_to_dpg """
+    texture_data = []
+    width = poster.shape[0]
+    height = poster.shape[1]
+
+    for i in range(width):
+        for j in range(height):
+            texture_data.append(poster[i, j, 2])
+            texture_data.append(poster[i, j, 1])
+            texture_data.append(poster[i, j, 0])
+            texture_data.append(255)
+
+    return texture_data
+
+
+def bench_texture(width: int = 1024, height: int = 768, repeat: int = 3) -> dict:
+    """ Попиксельный конвертер постера против векторного BGR -> RGBA float32 """
+    poster = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    timings = {"legacy": _measure(lambda: _legacy_poster_to_dpg(poster), 1),
+               "vectorized": _measure(lambda: api.texture_data(poster), repeat)}
+    _report("texture", **timings)
+    return timings
+
+
+def bench_blur(width: int = 1024, height: int = 768, ksize: int = 9, repeat: int = 3) -> dict:
+    """ Двумерная свертка SciPy из api.gaussian_blur_numpy против реализаций blur.py """
+    image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    kernel = (ksize, ksize)
+    timings = {"scipy2d": _measure(lambda: api.gaussian_blur_numpy(image, ksize=kernel), 1)}
+    for engine in (BlurEngine.SEPARABLE, BlurEngine.OPENCV, BlurEngine.BOX):
+        timings[engine.value] = _measure(lambda: gaussian_blur(image, kernel, engine=engine), repeat)
+    _report(f"blur k={ksize}", **timings)
+    return timings
+
+
+def bench_tiles(size: int = 1000, grid: tuple = (4, 4), repeat: int = 3) -> dict:
+    """ Analizator целиком против TiledAnalizator на растре, наложенном на самого себя """
+    win = WindowSettings(size, size)
+    base_settings = api.raster_settings(0, 20, 4)
+    base = api.create_raster(win, base_settings, False)
+    over = api.create_raster(win, api.raster_settings_double(base_settings, add_angle=45), False)
+    processed = ImageData(base.image, SourceType.PROCESSED)
+    model = api.build_template_model(base, over)
+    timings = {"single": _measure(lambda: Analizator(base, over, processed, template_model=model), repeat),
+               "tiled": _measure(lambda: TiledAnalizator(base, over, processed, template_model=model,
+                                                         grid=grid), repeat)}
+    _report(f"tiles {grid[0]}x{grid[1]}", **timings)
+    return timings
+
+
+def _moire_image(size: int, distance: int = 20, thickness: int = 4, add_angle: int = 45,
+                 noise: float = 0.001) -> np.ndarray:
+    """ Муар двух растров под маской, как в Analizator, с солевым шумом камеры """
+    win = WindowSettings(size, size)
+    base_settings = api.raster_settings(0, distance, thickness)
+    base = api.create_raster(win, base_settings, False)
+    over = api.create_raster(win, api.raster_settings_double(base_settings, add_angle=add_angle), False)
+    muar = ImageProcessor.masking(base.image, over.image)
+    speckle = np.random.default_rng(0).random(muar.shape) < noise
+    muar[speckle] = 255
+    return muar
+
+
+def bench_blobs(size: int = 1000, repeat: int = 3) -> dict:
+    """ findContours + convexHull против connectedComponentsWithStats на изображении муара """
+    muar = _moire_image(size)
+    timings = {"contours": _measure(lambda: ImageProcessor.hull_points(muar).centers_array, repeat),
+               "components": _measure(lambda: ImageProcessor.blob_set(muar).centroids, repeat),
+               "filtered": _measure(lambda: ImageProcessor.blob_set(muar, min_area=4).centroids, repeat),
+               "with_hulls": _measure(lambda: ImageProcessor.blob_set(muar).hulls_array, repeat)}
+    _report(f"blobs {size}", **timings)
+    return timings
+
+
+def bench_pipeline(width: int = 1280, height: int = 720, repeat: int = 20) -> dict:
+    """ api.processor_pipeline против FramePipeline с переиспользуемыми буферами """
+    rng = np.random.default_rng(0)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    top, left = height // 8, width // 6
+    frame[top:height - top, left:width - left] = rng.integers(
+        0, 256, (height - 2 * top, width - 2 * left, 3), dtype=np.uint8)
+    win = WindowSettings(1000, 1000)
+    raw = ImageData(frame, SourceType.RAW)
+    timings = {"processor_pipeline": _measure(lambda: api.processor_pipeline(raw, 100, 16, win), repeat)}
+    for factor in (1, 4, 8):
+        pipeline = FramePipeline(frame.shape, win, 16, coarse_factor=factor)
+        out = pipeline.new_out()
+        timings[f"frame_pipeline_c{factor}"] = _measure(lambda: pipeline.process(frame, 100, out), repeat)
+    _report(f"pipeline {width}x{height}", **timings)
+    return timings
+
+
+def bench_codecs(size: int = 1000, repeat: int = 3) -> dict:
+    """ Запись и чтение бинарного муара и кадра камеры в каждом формате, время против размера файла """
+    rng = np.random.default_rng(0)
+    frame = cv.GaussianBlur(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), (9, 9), 0)
+    images = {"binary": _moire_image(size), "camera": frame}
+    variants = {"png1": (Codec.PNG, 1), "png3": (Codec.PNG, 3), "png9": (Codec.PNG, 9),
+                "webp": (Codec.WEBP, None), "npy": (Codec.NPY, None), "bits": (Codec.BITS, None)}
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for image_name, image in images.items():
+            flags = cv.IMREAD_COLOR if image.ndim == 3 else cv.COLOR_BGR2GRAY
+            for name, (codec, level) in variants.items():
+                if codec is Codec.BITS and image.ndim == 3:
+                    continue
+                path = os.path.join(folder, f"{image_name}.{codec.value}")
+                encode = _measure(lambda: write_image(image, path, codec, level), repeat)
+                decode = _measure(lambda: read_image(path, flags), repeat)
+                if not np.array_equal(read_image(path, flags), image):
+                    raise ValueError(f"[!] Формат {name} изменил изображение {image_name}")
+                kbytes = os.path.getsize(path) / 1024
+                results[f"{image_name}_{name}"] = {"encode": encode, "decode": decode, "kbytes": kbytes}
+                print(f"[codecs {image_name} {size}] {name}: запись={encode * 1000:.2f}ms, "
+                      f"чтение={decode * 1000:.2f}ms, размер={kbytes:.1f}KB")
+    return results
+
+
+def bench_session(frames: int = 50, size: int = 1000, repeat: int = 3) -> dict:
+    """ Чтение снимков партии из отдельных PNG против кадров сессии через np.memmap """
+    muar = _moire_image(size)
+    with tempfile.TemporaryDirectory() as folder:
+        files = [os.path.join(folder, f"camera-{index}.png") for index in range(frames)]
+        for path in files:
+            write_image(muar, path, Codec.PNG, 1)
+        session_path = os.path.join(folder, "capture.mses")
+        with SessionWriter(session_path, frames, frames * muar.nbytes) as writer:
+            for _ in range(frames):
+                writer.append(muar, SourceType.PROCESSED)
+
+        def read_session():
+            reader = SessionReader(session_path)
+            return [int(reader.image_data(index).image.max()) for index in range(len(reader))]
+
+        timings = {"png_files": _measure(lambda: [api.load_processed_camera_image(path) for path in files], repeat),
+                   "session": _measure(read_session, repeat)}
+    _report(f"session {frames}x{size}", **timings)
+    return timings
+
+
+def check_groups(analyses: int = 2000, size: int = 200) -> dict:
+    """
+    Много тысяч анализов в одном процессе: прежние счетчики ido на 1e3 пакетов
+    и 1e6 групп обрывали процесс StopIteration примерно после 500 анализов.
+    Проверка, а не замер: при ошибке бросает AssertionError
+    """
+    win = WindowSettings(size, size)
+    base_settings = api.raster_settings(0, 12, 3)
+    base = api.create_raster(win, base_settings, False)
+    over = api.create_raster(win, api.raster_settings_double(base_settings, add_angle=45), False)
+    processed = ImageData(base.image, SourceType.PROCESSED)
+    resolution = FixedResolution(size, size)
+    first_pack = next(GroupPack.ido_generator)
+    started = timeit.default_timer()
+    for number in range(analyses):
+        try:
+            analizator = Analizator(base, over, processed, resolution=resolution)
+            pack = ImageProcessor.hull_points(analizator.muar_image)
+        except StopIteration as e:
+            raise AssertionError(f"[!] StopIteration на анализе {number}") from e
+        groups = pack.groups
+        for ido in range(len(groups)):
+            if pack.pick_group(ido) is not groups[ido]:
+                raise AssertionError(f"[!] pick_group({ido}) вернул не ту группу на анализе {number}")
+    elapsed = timeit.default_timer() - started
+    packs = next(GroupPack.ido_generator) - first_pack
+    if packs <= 1000:
+        raise AssertionError(f"[!] Создано только {packs} пакетов групп, ожидалось больше 1000")
+    print(f"[groups] OK: {analyses} анализов, {packs} пакетов групп, {elapsed / analyses * 1000:.2f}ms на анализ")
+    return {"analyses": analyses, "packs": packs, "elapsed": elapsed}
+
+
+BENCHMARKS = {"texture": bench_texture,
+              "blur": bench_blur,
+              "tiles": bench_tiles,
+              "blobs": bench_blobs,
+              "pipeline": bench_pipeline,
+              "codecs": bench_codecs,
+              "session": bench_session}
+
+CHECKS = {"groups": check_groups}
+
+
+def main(names=None):
+    names = names or list(BENCHMARKS)
+    for name in names:
+        (BENCHMARKS.get(name) or CHECKS[name])()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+import cv2 as cv
+import numpy as np
+from enum import Enum
+from functools import lru_cache
+from typing import Tuple, Callable, Dict
+
+# Типы, которые cv.GaussianBlur и cv.blur принимают без преобразования
+_OPENCV_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+# Начиная с этого размера ядра гауссиан приближается тремя блочными фильтрами
+_BOX_MIN_KSIZE = 31
+_BOX_PASSES = 3
+
+
+class BlurEngine(Enum):
+    AUTO = "auto"
+    SEPARABLE = "separable"
+    OPENCV = "opencv"
+    BOX = "box"
+
+
+def default_sigma(ksize: int) -> float:
+    """ Sigma по размеру ядра, как в cv.getGaussianKernel """
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+@lru_cache(maxsize=64)
+def gaussian_kernel(ksize: int, sigma: float) -> np.ndarray:
+    """ Нормированное одномерное ядро Гаусса, кэшируется по (ksize, sigma) """
+    x = np.linspace(-(ksize // 2), ksize // 2, ksize)
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    kernel /= kernel.sum()
+    kernel.setflags(write=False)
+    return kernel
+
+
+@lru_cache(maxsize=64)
+def box_sizes(sigma: float, passes: int = _BOX_PASSES) -> Tuple[int, ...]:
+    """ Нечетные размеры блочных фильтров, последовательное применение которых дает заданную sigma """
+    ideal = np.sqrt(12 * sigma ** 2 / passes + 1)
+    lower = int(np.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    amount = round((12 * sigma ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    return tuple(lower if i < amount else upper for i in range(passes))
+
+
+def _cast_like(result: np.ndarray, dtype) -> np.ndarray:
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        result = np.clip(np.rint(result), info.min, info.max)
+    return result.astype(dtype, copy=False)
+
+
+def _convolve_axis(image: np.ndarray, kernel: np.ndarray, axis: int) -> np.ndarray:
+    size = len(kernel)
+    radius = size // 2
+    padding = [(0, 0)] * image.ndim
+    padding[axis] = (radius, size - 1 - radius)
+    padded = np.pad(image, padding, mode="symmetric")
+    length = image.shape[axis]
+    result = np.zeros(image.shape, dtype=np.float64)
+    for shift, weight in enumerate(kernel[::-1]):
+        window = [slice(None)] * image.ndim
+        window[axis] = slice(shift, shift + length)
+        result += weight * padded[tuple(window)]
+    return result
+
+
+def _blur_separable(image: np.ndarray, ksize: Tuple[int, int], sigma: float) -> np.ndarray:
+    result = image.astype(np.float64)
+    result = _convolve_axis(result, gaussian_kernel(ksize[1], sigma), axis=0)
+    result = _convolve_axis(result, gaussian_kernel(ksize[0], sigma), axis=1)
+    return _cast_like(result, image.dtype)
+
+
+def _blur_opencv(image: np.ndarray, ksize: Tuple[int, int], sigma: float) -> np.ndarray:
+    return cv.GaussianBlur(image, ksize, sigmaX=sigma, sigmaY=sigma, borderType=cv.BORDER_REFLECT)
+
+
+def _blur_box(image: np.ndarray, ksize: Tuple[int, int], sigma: float) -> np.ndarray:
+    result = image.astype(np.float32)
+    for size in box_sizes(sigma):
+        result = cv.blur(result, (size, size), borderType=cv.BORDER_REFLECT)
+    return _cast_like(result, image.dtype)
+
+
+_ENGINES: Dict[BlurEngine, Callable[[np.ndarray, Tuple[int, int], float], np.ndarray]] = {
+    BlurEngine.SEPARABLE: _blur_separable,
+    BlurEngine.OPENCV: _blur_opencv,
+    BlurEngine.BOX: _blur_box}
+
+
+def select_engine(image: np.ndarray, ksize: Tuple[int, int]) -> BlurEngine:
+    """ Выбор реализации по размеру ядра и типу изображения """
+    if image.dtype.type not in _OPENCV_DTYPES:
+        return BlurEngine.SEPARABLE
+    if max(ksize) >= _BOX_MIN_KSIZE:
+        return BlurEngine.BOX
+    return BlurEngine.OPENCV
+
+
+def gaussian_blur(image: np.ndarray, ksize: Tuple[int, int] = (9, 9), sigma: float = 0,
+                  engine: BlurEngine = BlurEngine.AUTO) -> np.ndarray:
+    """
+    Размытие Гаусса выбранной реализацией
+
+    sigma: если 0, вычисляется по ksize[0] для обеих осей
+    engine: AUTO выбирает реализацию через select_engine
+    """
+    sigma = sigma or default_sigma(ksize[0])
+    if engine is BlurEngine.AUTO:
+        engine = select_engine(image, ksize)
+    return _ENGINES[engine](image, tuple(ksize), sigma)
@@ -1,50 +1,350 @@
+import time
 import cv2 as cv
 import numpy as np
 import threading
-from typing import Optional
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Optional, Tuple, Callable, Any
 from settings import CameraSettings
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+@dataclass
+class Frame:
+    seq: int
+    timestamp: float
+    image: np.ndarray
+
 
 class AsyncCamera:
-    def __init__(self, src=0, camera_settings: Optional[CameraSettings] = None):
+    """
+    Захват кадров в отдельном потоке в кольцевой буфер из slots кадров
+
+    Кадр с номером seq лежит в слоте seq % slots и остается неизменным, пока
+    камера не снимет еще slots - 1 кадров. Кадры, перезаписанные до того,
+    как их кто-то прочитал, учитываются в frames_dropped.
+
+    idle_timeout: если кадры никто не запрашивал дольше этого времени, поток
+    только вызывает cap.grab() без декодирования; после простоя свежий кадр
+    следует получать через wait_next
+    """
+
+    def __init__(self, src=0, camera_settings: Optional[CameraSettings] = None, slots: int = 4,
+                 idle_timeout: Optional[float] = None, capture: Optional[Any] = None):
         settings = camera_settings or CameraSettings()
         self.src = src
-        self.cap = cv.VideoCapture(src)
+        self.cap = capture if capture is not None else cv.VideoCapture(src)
         self.cap.set(cv.CAP_PROP_FRAME_WIDTH, settings.width)
         self.cap.set(cv.CAP_PROP_FRAME_HEIGHT, settings.height)
-        self.grabbed, self.frame = self.cap.read()
         self.processing = False
 
         self.thread = None
         self.read_lock = threading.Lock()
+        self._new_frame = threading.Condition(self.read_lock)
+
+        self.slots = max(2, slots)
+        self.idle_timeout = idle_timeout
+        self._last_access = time.monotonic()
+        self.grabbed, frame = self.cap.read()
+        self._buffers = [np.empty_like(frame) if frame is not None else None for _ in range(self.slots)]
+        self._timestamps = [0.0] * self.slots
+        self._consumed = [True] * self.slots
+        self.seq = -1
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_delivered = 0
+        if frame is not None:
+            self._publish(frame)
+
+    def _publish(self, frame: np.ndarray) -> None:
+        """ Вызывается под read_lock либо до запуска потока """
+        seq = self.seq + 1
+        slot = seq % self.slots
+        if self._buffers[slot] is not frame:
+            self._buffers[slot] = frame
+        self._timestamps[slot] = time.monotonic()
+        self._consumed[slot] = False
+        self.seq = seq
+        self.frames_captured += 1
 
     def update(self):
         while self.processing:
-            grabbed, frame = self.cap.read()
+            if self.idle_timeout is not None and time.monotonic() - self._last_access > self.idle_timeout:
+                self.cap.grab()
+                continue
+            slot = (self.seq + 1) % self.slots
+            buffer = self._buffers[slot]
             with self.read_lock:
+                if not self._consumed[slot]:
+                    self.frames_dropped += 1
+                # Слот освобождается заранее: читатели видят его номер кадра устаревшим
+                self._consumed[slot] = True
+            grabbed, frame = self.cap.read(image=buffer) if buffer is not None else self.cap.read()
+            with self._new_frame:
                 self.grabbed = grabbed
-                self.frame = frame
+                if grabbed and frame is not None:
+                    self._publish(frame)
+                    self._new_frame.notify_all()
 
     def start(self):
         if self.processing:
             print("[!] Камера уже начала съемку.")
             return
         self.processing = True
-        self.thread = threading.Thread(target=self.update, args=())
+        self.thread = threading.Thread(target=self.update, args=(), daemon=True)
         self.thread.start()
         return self
 
-    def read(self):
+    def _frame_locked(self, seq: int, copy: bool) -> Frame:
+        self._last_access = time.monotonic()
+        slot = seq % self.slots
+        if not self._consumed[slot]:
+            self._consumed[slot] = True
+            self.frames_delivered += 1
+        image = self._buffers[slot]
+        if copy:
+            image = image.copy()
+        else:
+            image = image.view()
+            image.flags.writeable = False
+        return Frame(seq, self._timestamps[slot], image)
+
+    def latest(self, copy: bool = True) -> Optional[Frame]:
+        """ Последний снятый кадр; при copy=False вид только для чтения без копирования """
         with self.read_lock:
-            grabbed = self.grabbed
-            self.frame: np.ndarray = self.frame
-            frame = self.frame.copy()
-        return grabbed, frame
+            if self.seq < 0:
+                return None
+            return self._frame_locked(self.seq, copy)
+
+    def wait_next(self, after_seq: Optional[int] = None, timeout: Optional[float] = None,
+                  copy: bool = True) -> Optional[Frame]:
+        """ Ожидание кадра новее after_seq (по умолчанию новее последнего) """
+        with self._new_frame:
+            self._last_access = time.monotonic()
+            after_seq = self.seq if after_seq is None else after_seq
+            if not self._new_frame.wait_for(lambda: self.seq > after_seq or not self.processing, timeout):
+                return None
+            if self.seq <= after_seq:
+                return None
+            return self._frame_locked(self.seq, copy)
+
+    def view(self) -> Optional[Frame]:
+        """ Последний кадр без копирования, действителен до следующих slots - 1 кадров """
+        return self.latest(copy=False)
+
+    def is_valid(self, frame: Frame) -> bool:
+        """ Не перезаписан ли слот кадра, полученного через view """
+        with self.read_lock:
+            return self.seq - frame.seq < self.slots - 1
+
+    @property
+    def frame(self) -> Optional[np.ndarray]:
+        with self.read_lock:
+            return self._buffers[self.seq % self.slots] if self.seq >= 0 else None
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        frame = self.latest(copy=True)
+        return self.grabbed, frame.image if frame else None
+
+    def stats(self) -> dict:
+        with self.read_lock:
+            return {"captured": self.frames_captured,
+                    "delivered": self.frames_delivered,
+                    "dropped": self.frames_dropped}
 
     def stop(self):
         self.processing = False
         self.thread: threading.Thread = self.thread
         self.thread.join()
+        with self._new_frame:
+            self._new_frame.notify_all()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def release(self):
         self.cap.release()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FakeCapture:
+    """
+    Замена cv.VideoCapture без устройства: по кругу отдает кадры видеофайла
+    или изображения из папки с частотой fps
+    """
+
+    def __init__(self, source: str, fps: float = 30.0, loop: bool = True):
+        self.source = Path(source)
+        self.fps = fps
+        self.loop = loop
+        self.width = None
+        self.height = None
+        self._video = None
+        self._files = []
+        self._index = 0
+        self._last_time = 0.0
+        self._opened = True
+        if self.source.is_dir():
+            self._files = sorted(path for path in self.source.iterdir()
+                                 if path.suffix.lower() in IMAGE_EXTENSIONS)
+            self._opened = bool(self._files)
+        else:
+            self._video = cv.VideoCapture(str(self.source))
+            self._opened = self._video.isOpened()
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def set(self, prop: int, value: float) -> bool:
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif prop == cv.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        elif prop == cv.CAP_PROP_FPS:
+            self.fps = value
+        else:
+            return False
+        return True
+
+    def get(self, prop: int) -> float:
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return float(self.width or 0)
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height or 0)
+        if prop == cv.CAP_PROP_FPS:
+            return float(self.fps)
+        return 0.0
+
+    def _pace(self):
+        if not self.fps:
+            return
+        delay = self._last_time + 1 / self.fps - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._last_time = time.monotonic()
+
+    def _next_frame(self) -> Optional[np.ndarray]:
+        if self._video is not None:
+            grabbed, frame = self._video.read()
+            if not grabbed and self.loop:
+                self._video.set(cv.CAP_PROP_POS_FRAMES, 0)
+                grabbed, frame = self._video.read()
+            return frame if grabbed else None
+        if self._index >= len(self._files):
+            if not self.loop:
+                return None
+            self._index = 0
+        frame = cv.imread(str(self._files[self._index]))
+        self._index += 1
+        return frame
+
+    def grab(self) -> bool:
+        self._pace()
+        if self._video is not None:
+            return self._video.grab()
+        self._index += 1
+        return self._opened
+
+    def read(self, image: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        self._pace()
+        frame = self._next_frame() if self._opened else None
+        if frame is None:
+            return False, image
+        if self.width and self.height and frame.shape[:2] != (self.height, self.width):
+            frame = cv.resize(frame, (self.width, self.height), interpolation=cv.INTER_AREA)
+        if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+        self._opened = False
+
+
+class CameraSession:
+    """
+    Долгоживущая сессия камеры
+
+    Камера открывается при первом запросе кадра, пропускает warmup_frames
+    кадров, пока устанавливается экспозиция, и закрывается сама, если кадры
+    не запрашивали дольше idle_timeout секунд.
+    """
+
+    def __init__(self, camera_settings: Optional[CameraSettings] = None, src=0, warmup_frames: int = 5,
+                 idle_timeout: Optional[float] = 60.0, frame_timeout: float = 2.0,
+                 capture_factory: Optional[Callable[[], Any]] = None):
+        self.camera_settings = camera_settings or CameraSettings()
+        self.src = src
+        self.warmup_frames = warmup_frames
+        self.idle_timeout = idle_timeout
+        self.frame_timeout = frame_timeout
+        self.capture_factory = capture_factory
+        self._camera: Optional[AsyncCamera] = None
+        self._last_used = time.monotonic()
+        self._watch_stop: Optional[threading.Event] = None
+        self._lock = threading.RLock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._camera is not None
+
+    @property
+    def camera(self) -> Optional[AsyncCamera]:
+        return self._camera
+
+    def touch(self):
+        """ Отметка использования камеры, откладывает закрытие по простою """
+        self._last_used = time.monotonic()
+
+    def _watch(self, camera: AsyncCamera, stop: threading.Event):
+        """ Один поток на открытие камеры: закрывает ее после idle_timeout без запросов """
+        while not stop.is_set():
+            idle = time.monotonic() - self._last_used
+            if idle < self.idle_timeout:
+                stop.wait(self.idle_timeout - idle)
+                continue
+            with self._lock:
+                if self._camera is camera and time.monotonic() - self._last_used >= self.idle_timeout:
+                    self.close()
+            return
+
+    def open(self) -> AsyncCamera:
+        with self._lock:
+            if self._camera is None:
+                capture = self.capture_factory() if self.capture_factory else None
+                camera = AsyncCamera(self.src, self.camera_settings, capture=capture)
+                camera.start()
+                frame = camera.latest(copy=False)
+                seq = frame.seq if frame else -1
+                for _ in range(self.warmup_frames):
+                    frame = camera.wait_next(seq, timeout=self.frame_timeout, copy=False)
+                    if frame is None:
+                        break
+                    seq = frame.seq
+                self._camera = camera
+                if self.idle_timeout:
+                    self._watch_stop = threading.Event()
+                    threading.Thread(target=self._watch, args=(camera, self._watch_stop), daemon=True).start()
+            self.touch()
+            return self._camera
+
+    def get_picture(self, fresh: bool = False) -> np.ndarray:
+        """ Кадр с открытой камеры; fresh - дождаться кадра, снятого после запроса """
+        camera = self.open()
+        frame = camera.wait_next(timeout=self.frame_timeout) if fresh else camera.latest()
+        if frame is None:
+            raise ValueError("[!] Камера не вернула кадр")
+        return frame.image
+
+    def close(self):
+        with self._lock:
+            if self._watch_stop is not None:
+                self._watch_stop.set()
+                self._watch_stop = None
+            if self._camera is None:
+                return
+            self._camera.stop()
+            self._camera.release()
+            self._camera = None
@@ -1,6 +1,10 @@
 import cv2 as cv
 import numpy as np
 import math
+import threading
+from enum import Enum
+from collections import OrderedDict
+from typing import Optional
 from model import Point, Section
 from settings import WindowSettings, RasterSettings
 from paths import save_data
@@ -63,3 +67,101 @@ class RasterFactory:
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.use_save:
             save_data(self._raster, self.settings.stringify())
+
+
+class AnalyticRasterFactory(RasterFactory):
+    """
+    Растр, вычисленный одним векторным проходом по координатам пикселей
+
+    Пиксель принадлежит полосе, если расстояние от него до ближайшей линии
+    (по нормали, по модулю distance) не больше половины толщины. Период
+    точный и не зависит от округления сдвигов, offset может быть дробным.
+    """
+
+    def __init__(self, win_settings: WindowSettings, raster_settings: RasterSettings, use_save=True,
+                 antialias=False):
+        super().__init__(win_settings, raster_settings, use_save=use_save)
+        self.antialias = antialias
+
+    def process(self):
+        height, width = self._raster.shape
+        angle = math.radians(self.settings.angle + 90)
+        distance = self.settings.distance
+        color = self.settings.color
+        value = color[0] if isinstance(color, tuple) else color
+
+        xphase = (np.arange(width) - self.center.cox) * math.cos(angle)
+        yphase = (np.arange(height) - self.center.coy) * math.sin(angle)
+        phase = yphase[:, None] + xphase[None, :]
+        phase -= self.settings.offset - distance / 2
+        np.remainder(phase, distance, out=phase)
+        phase -= distance / 2
+        np.abs(phase, out=phase)
+
+        # Покрытие 0.5 приходится на thickness / 2 + 0.5, как у cv.line
+        coverage = np.clip(self.settings.thickness / 2 + 1 - phase, 0, 1, out=phase)
+        if not self.antialias:
+            coverage = coverage >= 0.5
+        self._raster[:] = np.rint(coverage * value)
+        return self._raster
+
+
+class RasterRenderer(Enum):
+    LINES = "lines"
+    ANALYTIC = "analytic"
+
+
+RENDERERS = {RasterRenderer.LINES: RasterFactory,
+             RasterRenderer.ANALYTIC: AnalyticRasterFactory}
+
+
+class RasterCache:
+    """ LRU-кэш готовых растров с ограничением занимаемой памяти """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(win_settings: WindowSettings, raster_settings: RasterSettings, *variant) -> tuple:
+        return (win_settings.width, win_settings.height,
+                raster_settings.angle % 360, raster_settings.distance, raster_settings.thickness,
+                raster_settings.offset, tuple(raster_settings.color), *variant)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        with self._lock:
+            raster = self._items.get(key)
+            if raster is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return raster
+
+    def put(self, key: tuple, raster: np.ndarray) -> np.ndarray:
+        """ Сохраняет растр только для чтения и вытесняет давно не использованные """
+        raster.setflags(write=False)
+        if raster.nbytes > self.max_bytes:
+            return raster
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key).nbytes
+            self._items[key] = raster
+            self._bytes += raster.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return raster
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
@@ -1,11 +1,15 @@
 import math
+import numpy as np
 from numpy import ndarray
 from dataclasses import dataclass
-from typing import Optional, Any
+from typing import Optional, Any, Dict
 
 import api
 from settings import WindowSettings
-from analysis import Analizator, BY_DEFORM_MSG
+from analysis import Analizator, BY_DEFORM_MSG, deform_type
+from live import LiveInspection
+from thresholding import ThresholdMode
+from paths import IMAGE_EXTENSIONS
 import dearpygui.dearpygui as dpg
 import dearpygui.demo as demo
 
@@ -33,6 +37,7 @@ class Tag:
     BTN_CONTROL_SHOW_ANALYSIS = "BTN_CONTROL_SHOW_ANALYSIS"
     BTN_CONTROL_MAKE_RAW = "BTN_CONTROL_MAKE_RAW"
     BTN_MAKE_RAW_PROCESS = "BTN_MAKE_RAW_PROCESS"
+    BTN_CONTROL_LIVE = "BTN_CONTROL_LIVE"
 
     GROUP_INPUT_PARENT = "GROUP_INPUT_PARENT"
     GROUP_INPUT_BTN_COLLECT = "GROUP_INPUT_BTN_COLLECT"
@@ -64,6 +69,7 @@ class Tag:
     DATA_CHECK_NEED_SAVE = "DATA_CHECK_NEED_SAVE"
     DATA_CHECK_NEED_RAW_PROCESS = "DATA_CHECK_NEED_RAW_PROCESS"
     DATA_CHECK_DEBUG = "DATA_CHECK_DEBUG"
+    DATA_LIVE_STATS = "DATA_LIVE_STATS"
 
     INPUT_RASTER_SET_ANGLE = "INPUT_RASTER_SET_ANGLE"
     INPUT_RASTER_SET_DISTANCE = "INPUT_RASTER_SET_DISTANCE"
@@ -74,6 +80,7 @@ class Tag:
     INPUT_RASTER_DOUBLE_THICK = "INPUT_RASTER_DOUBLE_THICK"
     INPUT_RASTER_DOUBLE_DISTANCE = "INPUT_RASTER_DOUBLE_DISTANCE"
     INPUT_PROCESSOR_THRES_VALUE = "INPUT_PROCESSOR_THRES_VALUE"
+    INPUT_PROCESSOR_THRES_MODE = "INPUT_PROCESSOR_THRES_MODE"
 
     HANDLER_REG = "HANDLER_REG"
     MAIN_WIN_HANDLER = "MAIN_WIN_HANDLER"
@@ -108,7 +115,8 @@ _btn_labels = {Tag.BTN_INPUT_LOAD_BASE: "Load Base",
                Tag.BTN_CONTROL_SHOW_ANALYSIS: "Show Analysis Result",
                Tag.BTN_DATA_SHOW_CAMERA: "Show Camera",
                Tag.BTN_INPUT_RASTER_FACTORY: "Create Rasters",
-               Tag.BTN_MAKE_RAW_PROCESS: "Process Raw Image"}
+               Tag.BTN_MAKE_RAW_PROCESS: "Process Raw Image",
+               Tag.BTN_CONTROL_LIVE: "Live Inspection"}
 
 _inp_labels = {Tag.INPUT_RASTER_SET_ANGLE: "BRaster angle",
                Tag.INPUT_RASTER_SET_DISTANCE: "BRaster distance",
@@ -117,7 +125,8 @@ _inp_labels = {Tag.INPUT_RASTER_SET_ANGLE: "BRaster angle",
                Tag.INPUT_RASTER_DOUBLE_OFFSET: "DRaster offset",
                Tag.INPUT_RASTER_DOUBLE_THICK: "DRaster line thick",
                Tag.INPUT_RASTER_DOUBLE_DISTANCE: "DRaster distance",
-               Tag.INPUT_PROCESSOR_THRES_VALUE: "Set threshold"}
+               Tag.INPUT_PROCESSOR_THRES_VALUE: "Set threshold",
+               Tag.INPUT_PROCESSOR_THRES_MODE: "Threshold mode"}
 
 
 @dataclass
@@ -128,47 +137,102 @@ class DpgImageData:
     data: Any
 
 
-class TextureInstrument:
-    def _process_poster_to_dpg(self, poster: ndarray) -> DpgImageData:
-        texture_data = []
-        width = poster.shape[0]
-        height = poster.shape[1]
+@dataclass
+class _TextureSlot:
+    tag: str
+    width: int
+    height: int
+    buffer: np.ndarray
+
+
+class TextureManager:
+    """
+    Текстуры DearPyGui по слотам (Tag.TEXTURE_*) в реестре Tag.TEXTURE_REG
+
+    На слот и размер создается одна raw_texture над своим буфером float32,
+    обновления пишутся в этот буфер на месте. Текстура пересоздается только
+    при смене размера, виджеты изображений переключаются на новую.
+    """
+
+    def __init__(self, registry: str = Tag.TEXTURE_REG):
+        self._registry = registry
+        self._slots: Dict[str, _TextureSlot] = {}
+        self._images: Dict[str, str] = {}
+        self.allocations = 0
+        self.updates = 0
+
+    def texture(self, slot: str) -> Optional[str]:
+        current = self._slots.get(slot)
+        return current.tag if current else None
+
+    def _allocate(self, slot: str, width: int, height: int) -> _TextureSlot:
+        previous = self._slots.get(slot)
+        buffer = np.zeros(width * height * 4, dtype=np.float32)
+        current = _TextureSlot(f"{slot}_{width}x{height}", width, height, buffer)
+        dpg.add_raw_texture(width, height, buffer, format=dpg.mvFormat_Float_rgba,
+                            tag=current.tag, parent=self._registry)
+        self._slots[slot] = current
+        self.allocations += 1
+        for image_tag, image_slot in self._images.items():
+            if image_slot == slot and dpg.does_item_exist(image_tag):
+                dpg.configure_item(image_tag, texture_tag=current.tag, width=width, height=height)
+        if previous is not None and dpg.does_item_exist(previous.tag):
+            dpg.delete_item(previous.tag)
+        return current
+
+    def _slot(self, slot: str, width: int, height: int) -> _TextureSlot:
+        current = self._slots.get(slot)
+        if current is None or (current.width, current.height) != (width, height):
+            current = self._allocate(slot, width, height)
+        return current
+
+    def update(self, slot: str, image: ndarray) -> str:
+        """ Изображение OpenCV в текстуру слота """
+        height, width = image.shape[:2]
+        current = self._slot(slot, width, height)
+        api.texture_data(image, out=current.buffer)
+        dpg.set_value(current.tag, current.buffer)
+        self.updates += 1
+        return current.tag
+
+    def update_data(self, slot: str, dpg_data: DpgImageData) -> str:
+        """ Готовые данные RGBA float в текстуру слота """
+        current = self._slot(slot, dpg_data.width, dpg_data.height)
+        np.copyto(current.buffer, np.asarray(dpg_data.data, dtype=np.float32).reshape(-1))
+        dpg.set_value(current.tag, current.buffer)
+        self.updates += 1
+        return current.tag
+
+    def show(self, slot: str, image_tag: str, parent: str) -> bool:
+        """ Показать текстуру слота в виджете image_tag, существующий виджет переиспользуется """
+        current = self._slots.get(slot)
+        if current is None:
+            return False
+        if dpg.does_item_exist(image_tag):
+            dpg.configure_item(image_tag, texture_tag=current.tag, width=current.width, height=current.height)
+        else:
+            dpg.add_image(texture_tag=current.tag, tag=image_tag, parent=parent)
+        self._images[image_tag] = slot
+        return True
 
-        for i in range(width):
-            for j in range(height):
-                texture_data.append(poster[i, j, 2])
-                texture_data.append(poster[i, j, 1])
-                texture_data.append(poster[i, j, 0])
-                texture_data.append(255)
 
-        return DpgImageData(width, height, None, texture_data)
+class TextureInstrument:
+    textures: TextureManager
 
     def paste_texture(self, texture_tag, dpg_data: Optional[DpgImageData] = None, poster: Optional[ndarray] = None):
         if dpg_data is None and poster is None:
             return False
 
-        if dpg.does_item_exist(texture_tag):
-            dpg.delete_item(texture_tag)
-
-        if not dpg_data:
-            dpg_data = self._process_poster_to_dpg(poster)
-
-        dpg.add_static_texture(dpg_data.width, dpg_data.height,
-                               dpg_data.data, tag=texture_tag, parent=Tag.TEXTURE_REG)
+        if dpg_data is not None:
+            self.textures.update_data(texture_tag, dpg_data)
+        else:
+            self.textures.update(texture_tag, poster)
         return True
 
     def paste_image(self, texture_tag, on_view=True):
-        if not dpg.does_item_exist(texture_tag):
-            return False
-
         win_tag = Tag.WIN_VIEW if on_view else Tag.WIN_MAIN_VIEW
         image_tag = Tag.VIEW_IMAGE if on_view else Tag.MAIN_POSTER_IMAGE
-
-        if dpg.does_item_exist(image_tag):
-            dpg.delete_item(image_tag)
-
-        dpg.add_image(texture_tag=texture_tag, tag=image_tag, parent=win_tag)
-        return True
+        return self.textures.show(texture_tag, image_tag, win_tag)
 
 
 class Storage(TextureInstrument):
@@ -176,8 +240,13 @@ class Storage(TextureInstrument):
         self._last_dict = {}
         self._objects = {}
         self._analyzator: Optional[Analizator] = None
+        self._template_model = None
         self._main_view_used = False
         self.distance_thick_min_diff = 5
+        self._live: Optional[LiveInspection] = None
+        self._live_seq = -1
+        self._live_threshold = 100
+        self.textures = TextureManager()
 
     def callback(self, sender, app_data, user_data):
         print(sender)
@@ -185,34 +254,37 @@ class Storage(TextureInstrument):
         print(user_data)
 
     def load(self, sender, app_data, type_tag):
-        def _set_texture_name():
-            tag_dict = {Tag.TEXTURE_BASE: Tag.DATA_TEX_BASE_NAME,
-                        Tag.TEXTURE_OVER: Tag.DATA_TEX_OVER_NAME,
-                        Tag.TEXTURE_RAW: Tag.DATA_TEX_RAW_NAME,
-                        Tag.TEXTURE_PROCESS: Tag.DATA_TEX_PROCESS_NAME}
-            dpg.configure_item(
-                item=tag_dict[type_tag], default_value=file_name)
-
         self._last_dict = app_data
         path = app_data["file_path_name"]
-        file_name = app_data["file_name"][:70]
-
-        width, height, channels, data = dpg.load_image(path)
-        dpg_image_data = DpgImageData(width, height, channels, data)
+        file_name = app_data["file_name"]
 
         texture_to_data_tag = {Tag.TEXTURE_BASE: "raster",
                                Tag.TEXTURE_OVER: "raster",
                                Tag.TEXTURE_RAW: "raw",
                                Tag.TEXTURE_PROCESS: "process"}
 
-        self._objects[type_tag] = api.load_image_by_tag(
+        image_data = api.load_image_by_tag(
             path, texture_to_data_tag[type_tag])
-        self.paste_texture(type_tag, dpg_data=dpg_image_data)
+        if image_data is None or image_data.image is None:
+            return
+        self.show_loaded(type_tag, image_data, file_name)
+
+    def show_loaded(self, type_tag, image_data, file_name: str):
+        """ Показ изображения, уже находящегося в памяти, без чтения файла с диска """
+        tag_dict = {Tag.TEXTURE_BASE: Tag.DATA_TEX_BASE_NAME,
+                    Tag.TEXTURE_OVER: Tag.DATA_TEX_OVER_NAME,
+                    Tag.TEXTURE_RAW: Tag.DATA_TEX_RAW_NAME,
+                    Tag.TEXTURE_PROCESS: Tag.DATA_TEX_PROCESS_NAME}
+
+        self._objects[type_tag] = image_data
+        if type_tag in (Tag.TEXTURE_BASE, Tag.TEXTURE_OVER):
+            self._template_model = None
+        self.paste_texture(type_tag, poster=image_data.image)
         self.paste_image(type_tag, on_view=True)
-        _set_texture_name()
+        dpg.configure_item(item=tag_dict[type_tag], default_value=file_name[:70])
 
     def make_raw_image(self, sender, app_data, user_data):
-        if not dpg.does_item_exist(Tag.TEXTURE_BASE):
+        if self.textures.texture(Tag.TEXTURE_BASE) is None:
             return
 
         self.paste_image(Tag.TEXTURE_BASE, on_view=False)
@@ -227,7 +299,9 @@ class Storage(TextureInstrument):
         if not all([base, over, process]):
             return
 
-        self._analyzator = Analizator(base, over, process)
+        if self._template_model is None:
+            self._template_model = api.build_template_model(base, over)
+        self._analyzator = Analizator(base, over, process, template_model=self._template_model)
 
     def show_analysis_poster(self, sender, app_data, user_data):
         if not self._analyzator:
@@ -235,14 +309,65 @@ class Storage(TextureInstrument):
         poster = self._analyzator.poster(select_persentile90=True)
         result = self._analyzator.has_deform()
         dpg.configure_item(
-            Tag.DATA_RESULT_DEF, default_value=BY_DEFORM_MSG.get(result, "No defects"))
+            Tag.DATA_RESULT_DEF, default_value=BY_DEFORM_MSG[deform_type(result)])
         api.imshow(poster)
 
+    def toggle_live(self, sender, app_data, user_data):
+        if self._live is not None:
+            self.stop_live()
+            return
+
+        base = self._objects.get(Tag.TEXTURE_BASE)
+        over = self._objects.get(Tag.TEXTURE_OVER)
+        if not all([base, over]):
+            return
+
+        self._live_threshold = dpg.get_value(Tag.INPUT_PROCESSOR_THRES_VALUE)
+        self._live = LiveInspection(api.get_camera_session(), base, over,
+                                    threshold_value=lambda: self._live_threshold, top_offset=16,
+                                    threshold_mode=self.threshold_mode())
+        self._live.start()
+
+    @staticmethod
+    def threshold_mode() -> ThresholdMode:
+        return ThresholdMode(dpg.get_value(Tag.INPUT_PROCESSOR_THRES_MODE))
+
+    @staticmethod
+    def show_threshold(value: int) -> None:
+        """ Автоматически выбранный порог показывается на ползунке ручного """
+        if dpg.get_value(Tag.INPUT_PROCESSOR_THRES_MODE) != ThresholdMode.MANUAL.value:
+            dpg.set_value(Tag.INPUT_PROCESSOR_THRES_VALUE, value)
+
+    def stop_live(self):
+        if self._live is None:
+            return
+        self._live.stop()
+        self._live = None
+        self._live_seq = -1
+
+    def poll_live(self):
+        """ Вызывается на каждом кадре интерфейса, забирает последний результат без ожидания """
+        if self._live is None:
+            return
+        self._live_threshold = dpg.get_value(Tag.INPUT_PROCESSOR_THRES_VALUE)
+        result = self._live.latest_result()
+        if result is None or result.seq == self._live_seq:
+            return
+        self._live_seq = result.seq
+        self.show_threshold(result.threshold)
+
+        verdict = BY_DEFORM_MSG[deform_type(result.has_deform)]
+        dpg.configure_item(Tag.DATA_RESULT_DEF, default_value=verdict)
+        stats = " ".join(f"{stage['stage']}:{stage['fps']:.1f}fps/{stage['latency_ms']:.0f}ms"
+                         for stage in self._live.stage_stats())
+        dpg.configure_item(Tag.DATA_LIVE_STATS, default_value=stats)
+        if dpg.get_item_configuration(Tag.WIN_MAIN_VIEW)["show"]:
+            self.paste_texture(Tag.TEXTURE_ANALIZATOR_POSTER, poster=result.poster)
+            self.paste_image(Tag.TEXTURE_ANALIZATOR_POSTER, on_view=False)
+
     def camera_stream(self, sender, app_data, user_data):
-        api.camera()
         image_data = api.get_picture()
         api.imshow(image_data.image)
-        api.camera()
 
     def raster_factory(self, sender, app_data, user_data):
         tags = (Tag.INPUT_RASTER_SET_DISTANCE,
@@ -257,9 +382,13 @@ class Storage(TextureInstrument):
 
         need_save = dpg.get_value(Tag.DATA_CHECK_NEED_SAVE)
         base_raster = api.create_raster(
-            _win_dims[Tag.WIN_MAIN_VIEW], raster_base_settings, need_save)
+            _win_dims[Tag.WIN_MAIN_VIEW], raster_base_settings, False)
         over_raster = api.create_raster(
-            _win_dims[Tag.WIN_MAIN_VIEW], raster_over_settings, need_save)
+            _win_dims[Tag.WIN_MAIN_VIEW], raster_over_settings, False)
+        if need_save:
+            base_paths = api.save_raster_data(base_raster, raster_base_settings)
+            api.save_raster_data(over_raster, raster_over_settings)
+            api.save_template_model(api.build_template_model(base_raster, over_raster), base_paths)
 
         if dpg.get_value(Tag.DATA_CHECK_DEBUG):
             api.imshow(base_raster.image)
@@ -294,14 +423,13 @@ class Storage(TextureInstrument):
         top_offset = 16
         threshold_value = dpg.get_value(Tag.INPUT_PROCESSOR_THRES_VALUE)
         processed_image = api.processor_pipeline(raw_picture, threshold_value,
-                                                 top_offset, _win_dims[Tag.WIN_MAIN_VIEW])
+                                                 top_offset, _win_dims[Tag.WIN_MAIN_VIEW],
+                                                 threshold_mode=self.threshold_mode())
+        self.show_threshold(api.last_threshold())
 
         if dpg.get_value(Tag.DATA_CHECK_NEED_SAVE):
             saved_path = api.save_camera_image(processed_image.image)
-            app_data_body = {"file_path_name": saved_path["to_camera"],
-                             "file_name": saved_path["to_camera_filename"],
-                             "_INNER_CALL": True}
-            self.load(None, app_data_body, Tag.TEXTURE_PROCESS)
+            self.show_loaded(Tag.TEXTURE_PROCESS, processed_image, saved_path["to_camera_filename"])
 
         if dpg.get_value(Tag.DATA_CHECK_DEBUG):
             api.imshow(processed_image.image)
@@ -319,18 +447,13 @@ class Storage(TextureInstrument):
 
         self._main_view_used = True
 
-        api.camera()
         raw_picture = api.get_picture()
-        api.camera()
 
         self._main_view_used = False
 
         if dpg.get_value(Tag.DATA_CHECK_NEED_SAVE):
             saved_path = api.save_camera_image(raw_picture.image)
-            app_data_body = {"file_path_name": saved_path["to_camera"],
-                             "file_name": saved_path["to_camera_filename"],
-                             "_INNER_CALL": True}
-            self.load(None, app_data_body, Tag.TEXTURE_RAW)
+            self.show_loaded(Tag.TEXTURE_RAW, raw_picture, saved_path["to_camera_filename"])
 
         if dpg.get_value(Tag.DATA_CHECK_DEBUG):
             api.imshow(raw_picture.image)
@@ -420,6 +543,10 @@ class Provider(Storage):
         dpg.add_button(tag=btn_show_analysis, label=_btn_labels[btn_show_analysis], parent=group_control_tag,
                        callback=self.show_analysis_poster, user_data=Tag.TEXTURE_ANALIZATOR_POSTER)
 
+        btn_live = Tag.BTN_CONTROL_LIVE
+        dpg.add_button(tag=btn_live, label=_btn_labels[btn_live], parent=group_control_tag,
+                       callback=self.toggle_live)
+
         group_controls_tag = Tag.GROUP_CONTROL_PROCESS_COLLECT
         dpg.add_group(tag=group_controls_tag, horizontal=False,
                       parent=Tag.WIN_CONTROL, width=200)
@@ -449,6 +576,9 @@ class Provider(Storage):
         dpg.add_input_text(tag=Tag.DATA_RESULT_DEF, parent=group_load_data_tag,
                            default_value="...", label="Result",
                            show=True, enabled=False)
+        dpg.add_input_text(tag=Tag.DATA_LIVE_STATS, parent=group_load_data_tag,
+                           default_value="...", label="Live",
+                           show=True, enabled=False)
 
         dpg.add_checkbox(tag=Tag.DATA_CHECK_ANGLE_TYPE, label="Double Raster Angle Type",
                          parent=group_load_data_tag, callback=self.double_raster_type_changed,
@@ -500,6 +630,9 @@ class Provider(Storage):
         thres_input_tag = Tag.INPUT_PROCESSOR_THRES_VALUE
         dpg.add_drag_int(tag=thres_input_tag, label=_inp_labels[thres_input_tag], parent=group_control_process_tag,
                          min_value=10, max_value=250, default_value=100, callback=self.settings_filter)
+        thres_mode_tag = Tag.INPUT_PROCESSOR_THRES_MODE
+        dpg.add_combo(tag=thres_mode_tag, label=_inp_labels[thres_mode_tag], parent=group_control_process_tag,
+                      items=[mode.value for mode in ThresholdMode], default_value=ThresholdMode.MANUAL.value)
 
     def _construct_registers(self):
         dpg.add_texture_registry(tag=Tag.TEXTURE_REG)
@@ -567,14 +700,10 @@ class Provider(Storage):
                             width=file_width, height=file_height, callback=self.load, user_data=Tag.TEXTURE_PROCESS,
                             show=False, directory_selector=False, default_path=default_path)
 
-        dpg.add_file_extension(extension=".png", color=(
-            150, 255, 150, 255), parent=file_lbase)
-        dpg.add_file_extension(extension=".png", color=(
-            150, 255, 150, 255), parent=file_lover)
-        dpg.add_file_extension(extension=".png", color=(
-            150, 255, 150, 255), parent=file_lraw)
-        dpg.add_file_extension(extension=".png", color=(
-            150, 255, 150, 255), parent=file_lprocess)
+        for file_dialog in (file_lbase, file_lover, file_lraw, file_lprocess):
+            for extension in IMAGE_EXTENSIONS:
+                dpg.add_file_extension(extension=extension, color=(
+                    150, 255, 150, 255), parent=file_dialog)
 
 
 class Interface:
@@ -597,7 +726,12 @@ class Interface:
 
         self._apply()
 
-        dpg.start_dearpygui()
+        while dpg.is_dearpygui_running():
+            self.provider.poll_live()
+            dpg.render_dearpygui_frame()
+        self.provider.stop_live()
+        api.close_camera()
+        api.wait_saved()
         dpg.destroy_context()
 
     def start_demo(self):
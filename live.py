@@ -0,0 +1,249 @@
+import time
+import queue
+import threading
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional, Tuple, Callable, Any, List
+
+from analysis import Analizator
+from camera import CameraSession, Frame
+from pipeline import FramePipeline
+from thresholding import ThresholdMode
+from image_data import ImageData, SourceType
+from settings import WindowSettings
+from resolution import ResolutionPolicy, DEFAULT_RESOLUTION
+from stats import DistanceStatistics
+import api
+
+
+@dataclass
+class LiveResult:
+    seq: int
+    timestamp: float
+    has_deform: bool
+    persentiles: Tuple[float, float, float]
+    poster: np.ndarray
+    latency: float
+    threshold: int
+
+
+class StageStats:
+    """ Задержка и пропускная способность одной стадии """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self.processed += 1
+            self.last_latency = latency
+            self.total_latency += latency
+
+    def drop(self) -> None:
+        with self._lock:
+            self.dropped += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {"stage": self.name,
+                    "processed": self.processed,
+                    "dropped": self.dropped,
+                    "latency_ms": 1000 * self.total_latency / self.processed if self.processed else 0.0,
+                    "last_latency_ms": 1000 * self.last_latency,
+                    "fps": self.processed / elapsed if elapsed else 0.0}
+
+
+def _offer(stage_queue: queue.Queue, item: Any, stats: StageStats,
+           on_drop: Optional[Callable[[Any], None]] = None) -> None:
+    """
+    Кладет элемент в очередь, вытесняя самый старый, если следующая стадия не успевает,
+    вытесненный элемент передается в on_drop
+    """
+    while True:
+        try:
+            stage_queue.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                dropped = stage_queue.get_nowait()
+                stats.drop()
+            except queue.Empty:
+                continue
+            if on_drop is not None:
+                on_drop(dropped)
+
+
+class LiveInspection:
+    """
+    Непрерывный контроль: камера -> порог -> обрезка -> масштаб -> Analizator
+
+    Стадии работают в своих потоках и связаны очередями длины queue_size.
+    Если анализ не успевает, старые кадры выбрасываются, чтобы задержка не
+    накапливалась. Последний результат забирается через latest_result без
+    блокировки. resolution - рабочий размер Analizator, под него один раз
+    строится модель шаблона.
+    """
+
+    def __init__(self, session: CameraSession, base_raster: ImageData, over_raster: ImageData,
+                 threshold_value: Callable[[], int], top_offset: int = 16, queue_size: int = 1,
+                 frame_timeout: float = 1.0, threshold_mode: ThresholdMode = ThresholdMode.MANUAL,
+                 resolution: ResolutionPolicy = DEFAULT_RESOLUTION):
+        self._session = session
+        self._base_raster = base_raster
+        self._over_raster = over_raster
+        self._resolution = resolution
+        self._template_model = api.build_template_model(base_raster, over_raster, resolution)
+        self._threshold_value = threshold_value
+        self._threshold_mode = threshold_mode
+        self._top_offset = top_offset
+        self._frame_timeout = frame_timeout
+        height, width = base_raster.shape()[:2]
+        self._win_settings = WindowSettings(width, height)
+
+        # Свободные буферы результата обработки: буфер возвращается сюда,
+        # когда анализ закончил с ним или кадр выброшен из очереди, поэтому
+        # обработка никогда не пишет в буфер, который еще читает анализ.
+        # Новый буфер выделяется, только если свободных нет
+        self._pipeline: Optional[FramePipeline] = None
+        self._free_outputs: queue.SimpleQueue = queue.SimpleQueue()
+
+        self._frames = queue.Queue(maxsize=queue_size)
+        self._processed = queue.Queue(maxsize=queue_size)
+        self.stats = {name: StageStats(name) for name in ("capture", "process", "analysis")}
+
+        self._result: Optional[LiveResult] = None
+        self._result_lock = threading.Lock()
+        self._statistics = DistanceStatistics()
+        self._running = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._running.is_set()
+
+    def start(self):
+        if self.running:
+            return self
+        self._running.set()
+        self._threads = [threading.Thread(target=target, daemon=True)
+                         for target in (self._capture_loop, self._process_loop, self._analysis_loop)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running.clear()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def latest_result(self) -> Optional[LiveResult]:
+        with self._result_lock:
+            return self._result
+
+    def aggregated_persentiles(self, source: str = "exact") -> Optional[Tuple[float, float, float]]:
+        """ p50, p90, p99 по всем проанализированным кадрам с начала контроля """
+        with self._result_lock:
+            return self._statistics.persentiles(source)
+
+    def stage_stats(self) -> List[dict]:
+        return [stats.snapshot() for stats in self.stats.values()]
+
+    def _capture_loop(self) -> None:
+        stats = self.stats["capture"]
+        seq = -1
+        camera = None
+        while self.running:
+            started = time.monotonic()
+            try:
+                # Камера открывается один раз, за кадр только отмечается использование
+                if camera is None or camera is not self._session.camera:
+                    camera = self._session.open()
+                else:
+                    self._session.touch()
+                frame = camera.wait_next(seq, timeout=self._frame_timeout, copy=False)
+            except Exception as e:
+                camera = None
+                self.last_error = str(e)
+                time.sleep(self._frame_timeout)
+                continue
+            if frame is None:
+                continue
+            if seq >= 0 and frame.seq > seq + 1:
+                for _ in range(frame.seq - seq - 1):
+                    stats.drop()
+            seq = frame.seq
+            stats.record(time.monotonic() - started)
+            _offer(self._frames, (camera, frame), stats)
+
+    def _process_loop(self) -> None:
+        stats = self.stats["process"]
+        while self.running:
+            try:
+                camera, frame = self._frames.get(timeout=self._frame_timeout)
+            except queue.Empty:
+                continue
+            frame: Frame = frame
+            started = time.monotonic()
+            out = self._take_output(frame.image)
+            try:
+                processed = ImageData(self._pipeline.process(frame.image, self._threshold_value(), out),
+                                      SourceType.PROCESSED)
+            except Exception as e:
+                self._free_outputs.put(out)
+                self.last_error = str(e)
+                stats.drop()
+                continue
+            # Кадр брался из кольцевого буфера без копии: если слот успели
+            # перезаписать во время обработки, результат недостоверен
+            if not camera.is_valid(frame):
+                self._free_outputs.put(out)
+                stats.drop()
+                continue
+            stats.record(time.monotonic() - started)
+            _offer(self._processed, (frame.seq, frame.timestamp, self._pipeline.last_threshold, processed), stats,
+                   on_drop=lambda item: self._free_outputs.put(item[3].image))
+
+    def _take_output(self, image: np.ndarray) -> np.ndarray:
+        if self._pipeline is None:
+            self._pipeline = FramePipeline(image.shape, self._win_settings, self._top_offset,
+                                           threshold_mode=self._threshold_mode)
+        try:
+            return self._free_outputs.get_nowait()
+        except queue.Empty:
+            return self._pipeline.new_out()
+
+    def _analysis_loop(self) -> None:
+        stats = self.stats["analysis"]
+        while self.running:
+            try:
+                seq, timestamp, threshold, processed = self._processed.get(timeout=self._frame_timeout)
+            except queue.Empty:
+                continue
+            started = time.monotonic()
+            try:
+                analizator = Analizator(self._base_raster, self._over_raster, processed,
+                                        template_model=self._template_model, resolution=self._resolution)
+                result = LiveResult(seq, timestamp, bool(analizator.has_deform()),
+                                    tuple(float(value) for value in analizator.persentiles),
+                                    analizator.poster(select_persentile90=True),
+                                    time.monotonic() - timestamp, threshold)
+                distances = analizator.distance_values
+            except Exception as e:
+                self.last_error = str(e)
+                stats.drop()
+                continue
+            finally:
+                self._free_outputs.put(processed.image)
+            stats.record(time.monotonic() - started)
+            with self._result_lock:
+                self._result = result
+                self._statistics.add(distances)
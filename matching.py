@@ -0,0 +1,49 @@
+import numpy as np
+from typing import Tuple
+
+# Сколько соседей запрашивается у дерева, чтобы при равных расстояниях
+# выбрать центр шаблона с меньшим индексом, как это делал перебор
+_TIE_NEIGHBOURS = 8
+
+
+class NearestMatcher:
+    """ Пространственный индекс (k-d дерево) над центрами шаблона """
+
+    def __init__(self, template_points: np.ndarray):
+        # SciPy загружается только при первом построении индекса, не при import api
+        from scipy.spatial import cKDTree
+        self._points = np.asarray(template_points, dtype=np.float64).reshape(-1, 2)
+        self._tree = cKDTree(self._points) if len(self._points) else None
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def points(self) -> np.ndarray:
+        return self._points
+
+    def query(self, muar_points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ближайший центр шаблона для каждой точки муара одним пакетом
+
+        Возвращает индексы центров шаблона и расстояния до них. При равных
+        расстояниях выбирается центр с меньшим индексом.
+        """
+        muar_points = np.asarray(muar_points, dtype=np.float64).reshape(-1, 2)
+        if self._tree is None or len(muar_points) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+        k = min(_TIE_NEIGHBOURS, len(self._points))
+        distances, indexes = self._tree.query(muar_points, k=k)
+        if k == 1:
+            indexes = indexes.reshape(-1, 1)
+            distances = distances.reshape(-1, 1)
+
+        # Дерево возвращает соседей в произвольном порядке при равенстве
+        # расстояний, поэтому среди ближайших берется наименьший индекс
+        diff = muar_points[:, None, :] - self._points[indexes]
+        squared = np.einsum("ijk,ijk->ij", diff, diff)
+        nearest = squared == squared.min(axis=1, keepdims=True)
+        indexes = np.where(nearest, indexes, np.iinfo(np.intp).max).min(axis=1)
+        distances = np.hypot(*(muar_points - self._points[indexes]).T)
+        return indexes, distances
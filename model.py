@@ -1,4 +1,7 @@
 import math
+import itertools
+import cv2 as cv
+import numpy as np
 from enum import IntEnum, Enum
 from typing import List, Optional
 from functools import total_ordering
@@ -47,6 +50,10 @@ class Point:
     def to_tuple(self):
         return self.cox, self.coy
 
+    def to_pixel(self):
+        """ Целые координаты для рисования средствами OpenCV """
+        return self.to_tuple()
+
     def __str__(self):
         return f"Point({self.cox}, {self.coy})"
 
@@ -62,6 +69,33 @@ class Point:
         return (self._angle(), self._radius()) > (other._angle(), other._radius())
 
 
+class PointF(Point):
+    """ Точка с дробными координатами, например центр масс пятна """
+
+    def __init__(self, cox: float, coy: float):
+        self.cox = float(cox)
+        self.coy = float(coy)
+
+    def to_pixel(self):
+        return int(round(self.cox)), int(round(self.coy))
+
+    def __str__(self):
+        return f"PointF({self.cox:.2f}, {self.coy:.2f})"
+
+
+def points_from_array(centers: np.ndarray) -> List[Point]:
+    """ Point для целочисленного массива (N, 2), PointF для дробного """
+    point_type = PointF if np.issubdtype(centers.dtype, np.floating) else Point
+    return [point_type(*center) for center in centers.tolist()]
+
+
+def pixel_coords(centers: np.ndarray) -> np.ndarray:
+    """ Массив центров (N, 2) в целых координатах пикселей """
+    if np.issubdtype(centers.dtype, np.floating):
+        return np.rint(centers).astype(np.intp)
+    return centers
+
+
 class Section:
     def __init__(self, pta: Point, ptb: Point):
         self.pta = pta
@@ -112,11 +146,14 @@ class DeformType(Enum):
     inDeform = "inDeform"
     outDeform = "outDeform"
     noneDeform = "noneDeform"
+    # Деформация есть, но ее вид по перцентилям расстояний не определяется
+    anyDeform = "anyDeform"
 
 
 @total_ordering
 class Group:
-    ido_generator = (i for i in range(int(1e6)))
+    # Бесконечный счетчик: next у itertools.count атомарен под GIL
+    ido_generator = itertools.count()
 
     def __init__(self, hull_points: list):
         self.ido = next(self.ido_generator)
@@ -142,21 +179,28 @@ class Group:
 
 
 class GroupPack:
-    ido_generator = (i for i in range(int(1e3)))
+    ido_generator = itertools.count()
 
     def __init__(self, groups: List[Group]):
         self.ido = next(self.ido_generator)
         self._groups = groups
+        self._ordered: Optional[List[Group]] = None
+
+    def _ordered_groups(self) -> List[Group]:
+        """ Группы по возрастанию ido, сортируются один раз на пакет """
+        if self._ordered is None:
+            self._ordered = sorted(self._groups, key=lambda x: x.ido)
+        return self._ordered
 
     def pick_group(self, ido: int) -> Optional[Group]:
         try:
-            return sorted(self._groups, key=lambda x: x.ido)[ido]
+            return self._ordered_groups()[ido]
         except IndexError:
             return None
 
     @property
     def groups(self) -> List[Group]:
-        return sorted(self._groups)
+        return self._ordered_groups()
 
     @property
     def centers(self) -> List[Point]:
@@ -174,3 +218,136 @@ class GroupPack:
 
     def __repr__(self):
         return self.__str__()
+
+
+class PointArray:
+    """ Вершины всех групп одним непрерывным массивом (N, 2) со смещениями групп """
+
+    def __init__(self, coords: np.ndarray, offsets: np.ndarray):
+        self.coords = coords
+        self.offsets = offsets
+
+    @classmethod
+    def from_hulls(cls, hulls: List[np.ndarray]):
+        if not hulls:
+            return cls(np.empty((0, 2), dtype=np.int32), np.zeros(1, dtype=np.intp))
+        coords = np.concatenate([hull.reshape(-1, 2) for hull in hulls]).astype(np.int32, copy=False)
+        offsets = np.zeros(len(hulls) + 1, dtype=np.intp)
+        np.cumsum([len(hull) for hull in hulls], out=offsets[1:])
+        return cls(coords, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def group(self, index: int) -> np.ndarray:
+        return self.coords[self.offsets[index]:self.offsets[index + 1]]
+
+    def centers(self) -> np.ndarray:
+        """ Центры всех групп за один проход, как Group.center """
+        if len(self) == 0:
+            return np.empty((0, 2), dtype=np.int64)
+        sums = np.add.reduceat(self.coords.astype(np.int64), self.offsets[:-1], axis=0)
+        return sums // self.counts[:, None] + 1
+
+    def to_points(self) -> List[Point]:
+        return [Point(*vertex) for vertex in self.coords.tolist()]
+
+
+class ArrayGroupPack(GroupPack):
+    """ Колоночный вариант GroupPack, объекты Group и Point создаются только по запросу """
+
+    def __init__(self, point_array: PointArray):
+        super().__init__([])
+        self.point_array = point_array
+        self._groups = None
+        self._centers = None
+
+    def _materialize(self) -> List[Group]:
+        if self._groups is None:
+            self._groups = [Group(self.point_array.group(i)) for i in range(len(self.point_array))]
+            self._ordered = None
+        return self._groups
+
+    def pick_group(self, ido: int) -> Optional[Group]:
+        self._materialize()
+        return super().pick_group(ido)
+
+    @property
+    def groups(self) -> List[Group]:
+        self._materialize()
+        return super().groups
+
+    @property
+    def centers_array(self) -> np.ndarray:
+        if self._centers is None:
+            self._centers = self.point_array.centers()
+        return self._centers
+
+    @property
+    def hulls_array(self) -> np.ndarray:
+        return self.point_array.coords
+
+    @property
+    def centers(self) -> List[Point]:
+        return points_from_array(self.centers_array)
+
+    @property
+    def hulls(self) -> List[Point]:
+        return self.point_array.to_points()
+
+    def __str__(self):
+        self._materialize()
+        return super().__str__()
+
+
+class BlobSet:
+    """
+    Пятна бинарного изображения из одного вызова connectedComponentsWithStats
+
+    labels - изображение меток, ids - метки пятен в наборе, areas - площади в
+    пикселях, boxes - рамки (N, 4) как x, y, ширина, высота, centroids - центры
+    масс (N, 2) float64. Выпуклые оболочки строятся только по запросу hulls.
+    """
+
+    def __init__(self, labels: np.ndarray, ids: np.ndarray, areas: np.ndarray, boxes: np.ndarray,
+                 centroids: np.ndarray):
+        self.labels = labels
+        self.ids = ids
+        self.areas = areas
+        self.boxes = boxes
+        self.centroids = centroids
+        self._hulls: Optional[PointArray] = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def filter(self, min_area: int = 0, max_area: Optional[int] = None):
+        """ Пятна с площадью в [min_area, max_area], например без мелкого шума """
+        keep = self.areas >= min_area
+        if max_area is not None:
+            keep &= self.areas <= max_area
+        if keep.all():
+            return self
+        return BlobSet(self.labels, self.ids[keep], self.areas[keep], self.boxes[keep], self.centroids[keep])
+
+    @property
+    def hulls(self) -> PointArray:
+        """ Выпуклые оболочки пятен набора, порядок групп как у findContours """
+        if self._hulls is None:
+            keep = np.zeros(self.labels.max() + 1, dtype=np.uint8)
+            keep[self.ids] = 255
+            contours, _ = cv.findContours(keep[self.labels], cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+            self._hulls = PointArray.from_hulls([cv.convexHull(cnt, returnPoints=True) for cnt in contours])
+        return self._hulls
+
+    @property
+    def centers_array(self) -> np.ndarray:
+        return self.centroids
+
+    @property
+    def hulls_array(self) -> np.ndarray:
+        return self.hulls.coords
@@ -1,84 +1,202 @@
+import atexit
+import struct
+import threading
 import cv2 as cv
 import numpy as np
 import configparser
-from typing import Dict
+from typing import Dict, Callable, Optional, Set
 from pathlib import Path
 from datetime import datetime
+from enum import Enum
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 SAVE_DATE_FORMAT = "%Y-%m-%d-%H-%M-%S-%f"
 
+_CONFIG_PATH = "settings.ini"
+_CONFIG_PATH_KEY = "Paths"
+_CONFIG_PATH_FIELDS = ("root", "directory", "folder_raster", "folder_settings", "folder_camera",
+                       "raster_filename", "raster_extension", "settings_filename", "settings_extension",
+                       "camera_filename", "camera_extension", "raster_codec", "camera_codec", "png_compression")
+
+# Секция [Paths] читается с диска один раз и обновляется при сохранении
+_config_path_data: Optional[dict] = None
+_config_lock = threading.Lock()
+
 
 def get_config_path_data() -> dict:
-    config_path_key = "Paths"
-    path = "settings.ini"
-    # path = Path(dirname(__file__)).parent / Path(path_to_ini)
-    config = configparser.ConfigParser()
-    config.read(path)
-    # print(config.sections())
-    return dict(config[config_path_key])
+    global _config_path_data
+    with _config_lock:
+        if _config_path_data is None:
+            config = configparser.ConfigParser()
+            config.read(_CONFIG_PATH)
+            _config_path_data = dict(config[_CONFIG_PATH_KEY])
+        return dict(_config_path_data)
+
+
+def reload_config_path_data() -> dict:
+    """ Перечитать settings.ini, если он изменен вне программы """
+    global _config_path_data
+    with _config_lock:
+        _config_path_data = None
+    return get_config_path_data()
 
 
 def save_config_path_data(**kwargs) -> None:
-    config_path_key = "Paths"
-    path = "settings.ini"
-    # path = Path(dirname(__file__)).parent / Path(path_to_ini)
-    config = configparser.ConfigParser()
-    config.read(path)
+    global _config_path_data
+    with _config_lock:
+        config = configparser.ConfigParser()
+        config.read(_CONFIG_PATH)
+        for field in _CONFIG_PATH_FIELDS:
+            if kwargs.get(field):
+                config.set(_CONFIG_PATH_KEY, field, kwargs[field])
+
+        with open(_CONFIG_PATH, 'w') as configfile:
+            config.write(configfile)
+        _config_path_data = dict(config[_CONFIG_PATH_KEY])
+
+
+class Codec(Enum):
+    """
+    Формат файла изображения, выбирается для папки ключом <папка>_codec в [Paths]
+
+    PNG - zlib с уровнем png_compression (0-9) из [Paths], WEBP - WebP без
+    потерь, NPY - массив NumPy без сжатия, самый быстрый на запись и чтение,
+    BITS - бинарное изображение (0 и 255) по одному биту на пиксель
+    """
+    PNG = "png"
+    WEBP = "webp"
+    NPY = "npy"
+    BITS = "bits"
+
+
+IMAGE_EXTENSIONS = tuple(f".{codec.value}" for codec in Codec)
+_BITS_HEADER = struct.Struct("<4sII")
+_BITS_MAGIC = b"MBIT"
+_NPY_MAGIC = b"\x93NUMPY"
+_WEBP_MAGIC = b"WEBP"
+
+
+def folder_codec(params_path: dict, folder: str) -> Optional[Codec]:
+    """ Формат папки raster или camera, None - формат по расширению, как раньше """
+    name = params_path.get(f"{folder}_codec", "").strip().lower()
+    if not name:
+        return None
+    try:
+        return Codec(name)
+    except ValueError:
+        raise ValueError(f"[!] Неизвестный формат {name} для папки {folder}")
+
+
+def _folder_extension(params_path: dict, folder: str) -> str:
+    codec = folder_codec(params_path, folder)
+    return codec.value if codec is not None else params_path["raster_extension"]
+
+
+def _png_compression(params_path: dict) -> Optional[int]:
+    level = params_path.get("png_compression", "").strip()
+    return int(level) if level else None
 
-    if kwargs.get("root"):
-        config.set(config_path_key, "root", kwargs["root"])
 
-    if kwargs.get("directory"):
-        config.set(config_path_key, "directory", kwargs["directory"])
+def is_binary(image: np.ndarray) -> bool:
+    """ Одноканальное изображение только из 0 и 255 """
+    return (image.ndim == 2 and image.dtype == np.uint8
+            and not cv.countNonZero(cv.inRange(image, 1, 254)))
 
-    if kwargs.get("folder_raster"):
-        config.set(config_path_key, "folder_raster", kwargs["folder_raster"])
 
-    if kwargs.get("folder_settings"):
-        config.set(config_path_key, "folder_settings",
-                   kwargs["folder_settings"])
+def _encode_default(image: np.ndarray, path: str, level: Optional[int]) -> bool:
+    return cv.imwrite(path, image)
 
-    if kwargs.get("folder_camera"):
-        config.set(config_path_key, "folder_camera", kwargs["folder_camera"])
 
-    if kwargs.get("raster_filename"):
-        config.set(config_path_key, "raster_filename",
-                   kwargs["raster_filename"])
+def _encode_png(image: np.ndarray, path: str, level: Optional[int]) -> bool:
+    params = [cv.IMWRITE_PNG_COMPRESSION, level] if level is not None else []
+    return cv.imwrite(path, image, params)
 
-    if kwargs.get("raster_extension"):
-        config.set(config_path_key, "raster_extension",
-                   kwargs["raster_extension"])
 
-    if kwargs.get("settings_filename"):
-        config.set(config_path_key, "settings_filename",
-                   kwargs["settings_filename"])
+def _encode_webp(image: np.ndarray, path: str, level: Optional[int]) -> bool:
+    # Качество больше 100 включает сжатие без потерь
+    return cv.imwrite(path, image, [cv.IMWRITE_WEBP_QUALITY, 101])
 
-    if kwargs.get("settings_extension"):
-        config.set(config_path_key, "settings_extension",
-                   kwargs["settings_extension"])
 
-    if kwargs.get("camera_filename"):
-        config.set(config_path_key, "camera_filename",
-                   kwargs["camera_filename"])
+def _encode_npy(image: np.ndarray, path: str, level: Optional[int]) -> bool:
+    # Через файловый объект, иначе np.save допишет .npy к имени
+    with open(path, "wb") as file:
+        np.save(file, image, allow_pickle=False)
+    return True
 
-    if kwargs.get("raster_extension"):
-        config.set(config_path_key, "raster_extension",
-                   kwargs["raster_extension"])
 
-    with open(path, 'wb') as configfile:
-        config.write(configfile)
+def _encode_bits(image: np.ndarray, path: str, level: Optional[int]) -> bool:
+    if not is_binary(image):
+        raise ValueError(f"[!] Формат bits только для бинарных изображений, передано {image.shape} {image.dtype}")
+    with open(path, "wb") as file:
+        file.write(_BITS_HEADER.pack(_BITS_MAGIC, image.shape[0], image.shape[1]))
+        file.write(np.packbits(image).tobytes())
+    return True
 
 
-def _path_to_save_files(raster: bool, settings: bool, camera: bool) -> dict:
+_ENCODERS = {None: _encode_default,
+             Codec.PNG: _encode_png,
+             Codec.WEBP: _encode_webp,
+             Codec.NPY: _encode_npy,
+             Codec.BITS: _encode_bits}
+
+
+def _decode_bits(path: str) -> np.ndarray:
+    with open(path, "rb") as file:
+        _, height, width = _BITS_HEADER.unpack(file.read(_BITS_HEADER.size))
+        packed = np.frombuffer(file.read(), dtype=np.uint8)
+    image = np.unpackbits(packed, count=height * width).reshape(height, width)
+    image *= 255
+    return image
+
+
+def _webp_gray(image: np.ndarray) -> bool:
+    # WebP без потерь всегда трехканальный: серое изображение возвращается с равными каналами
+    return image.ndim == 3 and image.shape[2] == 3 and np.array_equal(image[:, :, 0], image[:, :, 1]) \
+        and np.array_equal(image[:, :, 0], image[:, :, 2])
+
+
+def read_image(path: str, flags: int = cv.IMREAD_COLOR) -> Optional[np.ndarray]:
+    """
+    Чтение изображения любого формата из Codec, формат определяется по
+    содержимому файла, а не по расширению. flags как у cv.imread: с
+    IMREAD_COLOR одноканальные NPY и BITS приводятся к BGR, с
+    IMREAD_GRAYSCALE трехканальные - к серому. С IMREAD_ANYCOLOR WebP с
+    равными каналами (записанный из серого) возвращается серым, как PNG,
+    с IMREAD_UNCHANGED каналы WebP не меняются
+    """
+    with open(path, "rb") as file:
+        head = file.read(16)
+    if head.startswith(_NPY_MAGIC):
+        image = np.load(path, allow_pickle=False)
+    elif head.startswith(_BITS_MAGIC):
+        image = _decode_bits(path)
+    else:
+        image = cv.imread(path, flags)
+        if (image is not None and head[8:12] == _WEBP_MAGIC and flags != cv.IMREAD_UNCHANGED
+                and flags & cv.IMREAD_ANYCOLOR and _webp_gray(image)):
+            image = np.ascontiguousarray(image[:, :, 0])
+        return image
+    if flags == cv.IMREAD_COLOR and image.ndim == 2:
+        image = cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+    elif flags == cv.IMREAD_GRAYSCALE and image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    return image
+
+
+def _path_to_save_files(raster: bool, settings: bool, camera: bool, template: bool = False,
+                        name: Optional[str] = None) -> "SavedPaths":
+    """ name - дата в именах файлов, по умолчанию текущая """
     params_path = get_config_path_data()
-    name = datetime.now().strftime(SAVE_DATE_FORMAT)
-    paths = {}
+    paths = SavedPaths()
+    paths.name = name or datetime.now().strftime(SAVE_DATE_FORMAT)
+    name = paths.name
     if raster:
         raster_path = Path(
             params_path["root"]) / params_path["directory"] / params_path["folder_raster"]
-        to_raster = f'{raster_path}\\{params_path["raster_filename"]}-{name}.{params_path["raster_extension"]}'
+        raster_extension = _folder_extension(params_path, "raster")
+        to_raster = f'{raster_path}\\{params_path["raster_filename"]}-{name}.{raster_extension}'
         paths["to_raster"] = to_raster
-        paths["to_raster_filename"] = f'{params_path["raster_filename"]}-{name}.{params_path["raster_extension"]}'
+        paths["to_raster_filename"] = f'{params_path["raster_filename"]}-{name}.{raster_extension}'
     if settings:
         settings_path = Path(
             params_path["root"]) / params_path["directory"] / params_path["folder_settings"]
@@ -88,16 +206,156 @@ def _path_to_save_files(raster: bool, settings: bool, camera: bool) -> dict:
     if camera:
         camera_path = Path(
             params_path["root"]) / params_path["directory"] / params_path["folder_camera"]
-        to_camera = f'{camera_path}\\{params_path["camera_filename"]}-{name}.{params_path["raster_extension"]}'
+        camera_extension = _folder_extension(params_path, "camera")
+        to_camera = f'{camera_path}\\{params_path["camera_filename"]}-{name}.{camera_extension}'
         paths["to_camera"] = to_camera
-        paths["to_camera_filename"] = f'{params_path["camera_filename"]}-{name}.{params_path["raster_extension"]}'
+        paths["to_camera_filename"] = f'{params_path["camera_filename"]}-{name}.{camera_extension}'
+    if template:
+        template_path = Path(
+            params_path["root"]) / params_path["directory"] / params_path["folder_settings"]
+        template_filename = params_path.get("template_filename", "template")
+        to_template = f'{template_path}\\{template_filename}-{name}.npz'
+        paths["to_template"] = to_template
+        paths["to_template_filename"] = f'{template_filename}-{name}.npz'
 
     return paths
 
 
+class SavedPaths(dict):
+    """
+    Пути сохраняемых файлов, future завершается, когда все файлы записаны на диск
+
+    name - дата в именах файлов, по ней к сохранению привязываются другие файлы
+    """
+    future: Optional[Future] = None
+    name: Optional[str] = None
+
+    def wait(self, timeout: Optional[float] = None) -> "SavedPaths":
+        """ Дождаться записи, ошибка записи пробрасывается """
+        if self.future is not None:
+            self.future.result(timeout)
+        return self
+
+
+class SaveQueue:
+    """
+    Фоновая запись файлов на пуле потоков
+
+    Кодирование PNG и запись идут в workers потоках, submit сразу возвращает
+    Future. В очереди не больше max_pending заданий: если диск не успевает,
+    submit ждет свободного места (blocked - сколько раз ждал), чтобы память
+    не росла без ограничений. flush дожидается всех поставленных заданий.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 16):
+        self.max_pending = max_pending
+        self.blocked = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="save")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, job: Callable, *args) -> Future:
+        if not self._slots.acquire(blocking=False):
+            self.blocked += 1
+            self._slots.acquire()
+        try:
+            future = self._pool.submit(job, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[!] Ошибка сохранения -> {future.exception()}")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """ Ожидание записи всех заданий, False - если не успели за timeout """
+        with self._lock:
+            futures = list(self._pending)
+        return not wait(futures, timeout).not_done
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True)
+
+
+_save_queue: Optional[SaveQueue] = None
+_save_queue_lock = threading.Lock()
+
+
+def get_save_queue() -> SaveQueue:
+    global _save_queue
+    with _save_queue_lock:
+        if _save_queue is None:
+            _save_queue = SaveQueue()
+            atexit.register(_save_queue.shutdown)
+        return _save_queue
+
+
+def flush_saves(timeout: Optional[float] = None) -> bool:
+    """ Дождаться записи всех файлов, поставленных в очередь """
+    if _save_queue is None:
+        return True
+    return _save_queue.flush(timeout)
+
+
+def _snapshot(image: np.ndarray) -> np.ndarray:
+    # Кадр может быть перезаписан вызывающим кодом до записи, растры из кэша только для чтения
+    return image.copy() if image.flags.writeable else image
+
+
+def write_image(image: np.ndarray, path: str, codec: Optional[Codec] = None,
+                png_compression: Optional[int] = None) -> None:
+    """ Запись изображения в формате codec, None - формат по расширению path """
+    if not _ENCODERS[codec](image, path, png_compression):
+        raise OSError(f"[!] Не удалось записать {path}")
+
+
+def _write_text(text: str, path: str) -> None:
+    with open(path, mode='w') as file:
+        file.write(text)
+
+
+def _write_files(paths: SavedPaths, image_path: str, image: np.ndarray, codec: Optional[Codec],
+                 png_compression: Optional[int], settings_path: Optional[str] = None,
+                 settings: Optional[str] = None) -> SavedPaths:
+    if settings_path is not None:
+        _write_text(settings, settings_path)
+    write_image(image, image_path, codec, png_compression)
+    return paths
+
+
+def _submit_save(paths: SavedPaths, folder: str, image: np.ndarray, block: bool,
+                 settings_path: Optional[str] = None, settings: Optional[str] = None) -> SavedPaths:
+    params_path = get_config_path_data()
+    codec = folder_codec(params_path, folder)
+    if codec is Codec.BITS and not is_binary(image):
+        # В папку камеры пишутся и исходные кадры, и бинарные после обработки
+        codec = Codec.PNG
+        for key in (f"to_{folder}", f"to_{folder}_filename"):
+            paths[key] = paths[key][:-len(Codec.BITS.value)] + codec.value
+    paths.future = get_save_queue().submit(_write_files, paths, paths[f"to_{folder}"], _snapshot(image), codec,
+                                           _png_compression(params_path), settings_path, settings)
+    if block:
+        paths.wait()
+    return paths
+
+
 def save_image(image: np.ndarray, path: str):
     try:
-        cv.imwrite(path, image)
+        write_image(image, path)
     except FileNotFoundError or FileExistsError:
         print("[!] Сохранение файлов не удалось")
     except Exception as e:
@@ -105,29 +363,40 @@ def save_image(image: np.ndarray, path: str):
     return
 
 
-def save_raster(raster: np.ndarray) -> Dict[str, str]:
+def save_raster(raster: np.ndarray, block: bool = False) -> SavedPaths:
+    """ Пути возвращаются сразу, запись идет в фоне, block - дождаться записи, ошибка записи пробрасывается """
     paths = _path_to_save_files(True, False, False)
-    raster_path = paths["to_raster"]
-    save_image(raster, raster_path)
-    return paths
+    return _submit_save(paths, "raster", raster, block)
 
 
-def save_data(raster: np.ndarray, settings: str) -> Dict[str, str]:
+def save_data(raster: np.ndarray, settings: str, block: bool = False) -> SavedPaths:
+    """ Растр и его настройки, пути возвращаются сразу, запись идет в фоне """
     paths = _path_to_save_files(True, True, False)
-    raster_path, settings_path = paths["to_raster"], paths["to_settings"]
+    return _submit_save(paths, "raster", raster, block, paths["to_settings"], settings)
+
+
+def save_camera(camera: np.ndarray, block: bool = False) -> SavedPaths:
+    """ Снимок камеры, путь возвращается сразу, запись идет в фоне """
+    paths = _path_to_save_files(False, False, True)
+    return _submit_save(paths, "camera", camera, block)
+
 
+def _write_template(paths: SavedPaths, save: Callable[[str], None]) -> SavedPaths:
     try:
-        with open(settings_path, mode='w') as file:
-            file.write(settings)
-    except FileNotFoundError or FileExistsError:
-        print("[!] Сохранение настроек не удалось")
-        return
-    save_image(raster, raster_path)
+        save(paths["to_template"])
+    except (FileNotFoundError, FileExistsError) as e:
+        raise OSError(f"[!] Сохранение модели шаблона не удалось -> {e}") from e
     return paths
 
 
-def save_camera(camera: np.ndarray) -> Dict[str, str]:
-    paths = _path_to_save_files(False, False, True)
-    camera_path = paths["to_camera"]
-    save_image(camera, camera_path)
+def save_template(save: Callable[[str], None], raster_paths: SavedPaths, block: bool = False) -> SavedPaths:
+    """
+    Модель шаблона рядом с настройками растров, с той же датой в имени, что
+    и у сохранения растра raster_paths; save получает путь файла. Запись идет
+    в той же фоновой очереди, block - дождаться записи
+    """
+    paths = _path_to_save_files(False, False, False, template=True, name=raster_paths.name)
+    paths.future = get_save_queue().submit(_write_template, paths, save)
+    if block:
+        paths.wait()
     return paths
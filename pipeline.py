@@ -0,0 +1,152 @@
+import cv2 as cv
+import numpy as np
+from typing import Optional, Tuple
+
+from processor import _axis_bounds, _MAX_COARSE_FACTOR
+from settings import WindowSettings
+from thresholding import ThresholdMode, ThresholdSelector
+
+
+class FramePipeline:
+    """
+    Порог -> обрезка -> масштаб для потока кадров одного размера
+
+    То же, что api.processor_pipeline, но промежуточные буферы выделяются
+    один раз под размер кадра и переиспользуются через dst= функций OpenCV
+    и out= NumPy. Результат пишется в out, если он передан.
+
+    coarse_factor > 1: границы обрезки ищутся по уменьшенной в coarse_factor
+    раз маске, точно сканируются только крайние полосы. На кадрах 720p точный
+    проход np.max по строкам и столбцам не медленнее, поэтому по умолчанию 1.
+
+    allocations - сколько буферов выделено за все время, last_allocations -
+    за последний вызов process, в установившемся режиме с out это 0, в том
+    числе в ADAPTIVE: копия кадра и карта порогов тоже берутся из буферов.
+    Гистограммы и пороги плиток размером с сетку не считаются.
+    threshold_mode: режим выбора порога, выбранный порог - last_threshold
+    """
+
+    def __init__(self, frame_shape: Tuple[int, ...], win_settings: WindowSettings, top_offset: int = 16,
+                 coarse_factor: int = 1, threshold_mode: ThresholdMode = ThresholdMode.MANUAL):
+        self.win_settings = win_settings
+        self.selector = ThresholdSelector(threshold_mode)
+        self.top_offset = top_offset
+        self.coarse_factor = min(max(coarse_factor, 1), _MAX_COARSE_FACTOR)
+        self.allocations = 0
+        self.last_allocations = 0
+        self.calls = 0
+        self._frame_shape: Optional[Tuple[int, ...]] = None
+        self._allocate(frame_shape)
+
+    def _buffer(self, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        self.allocations += 1
+        self.last_allocations += 1
+        return np.empty(shape, dtype=dtype)
+
+    def _allocate(self, frame_shape: Tuple[int, ...]) -> None:
+        height, width = frame_shape[:2]
+        factor = self.coarse_factor
+        self._frame_shape = tuple(frame_shape)
+        self._gray = self._buffer((height, width))
+        self._binary = self._buffer((height, width))
+        self._rows = self._buffer((height,))
+        self._cols = self._buffer((width,))
+        # Буферы ADAPTIVE выделяются при первом кадре в этом режиме
+        self._adaptive: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        if factor > 1:
+            self._main_shape = (height // factor * factor, width // factor * factor)
+            self._small = self._buffer((height // factor, width // factor))
+            self._small_rows = self._buffer((height // factor,))
+            self._small_cols = self._buffer((width // factor,))
+            self._band_rows = self._buffer((factor,))
+            self._band_cols = self._buffer((factor,))
+
+    @property
+    def last_threshold(self) -> int:
+        return self.selector.value
+
+    @property
+    def out_shape(self) -> Tuple[int, int]:
+        return self.win_settings.height, self.win_settings.width
+
+    def new_out(self) -> np.ndarray:
+        """ Буфер результата под out """
+        return np.empty(self.out_shape, dtype=np.uint8)
+
+    def _exact_bounds(self, mask: np.ndarray, rows: np.ndarray, cols: np.ndarray):
+        # np.max с out заметно быстрее cv.reduce(REDUCE_MAX) по строкам
+        row_bounds = _axis_bounds(np.max(mask, axis=1, out=rows))
+        if row_bounds is None:
+            return None
+        col_bounds = _axis_bounds(np.max(mask, axis=0, out=cols))
+        return row_bounds[0], row_bounds[1], col_bounds[0], col_bounds[1]
+
+    def _band(self, band: np.ndarray, axis: int) -> Tuple[int, int]:
+        # Полоса шириной factor у найденного блока, в ней есть ненулевой пиксель
+        out = self._band_rows if axis == 1 else self._band_cols
+        return _axis_bounds(np.max(band, axis=axis, out=out))
+
+    def _coarse_bounds(self, binary: np.ndarray):
+        factor = self.coarse_factor
+        main_h, main_w = self._main_shape
+        if not main_h or not main_w:
+            return self._exact_bounds(binary, self._rows, self._cols)
+
+        candidates = []
+        main = binary[:main_h, :main_w]
+        cv.resize(main, self._small.shape[::-1], dst=self._small, interpolation=cv.INTER_AREA)
+        coarse = self._exact_bounds(self._small, self._small_rows, self._small_cols)
+        if coarse is not None:
+            top, down, left, right = (bound * factor for bound in coarse)
+            top += self._band(main[top:top + factor], 1)[0]
+            down -= factor - self._band(main[down - factor:down], 1)[1]
+            left += self._band(main[:, left:left + factor], 0)[0]
+            right -= factor - self._band(main[:, right - factor:right], 0)[1]
+            candidates.append((top, down, left, right))
+
+        # Остатки за целыми блоками: меньше factor строк или столбцов
+        height, width = binary.shape
+        if main_h < height:
+            strip = self._exact_bounds(binary[main_h:], self._rows[main_h:], self._cols)
+            if strip is not None:
+                candidates.append((strip[0] + main_h, strip[1] + main_h, strip[2], strip[3]))
+        if main_w < width:
+            strip = self._exact_bounds(binary[:, main_w:], self._rows, self._cols[main_w:])
+            if strip is not None:
+                candidates.append((strip[0], strip[1], strip[2] + main_w, strip[3] + main_w))
+
+        if not candidates:
+            return None
+        tops, downs, lefts, rights = zip(*candidates)
+        return min(tops), max(downs), min(lefts), max(rights)
+
+    def process(self, image: np.ndarray, threshold_value: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """ Кадр BGR или серый -> обрезанное бинарное изображение размера окна в out """
+        self.calls += 1
+        self.last_allocations = 0
+        if image.shape != self._frame_shape:
+            self._allocate(image.shape)
+        if out is None:
+            out = self._buffer(self.out_shape)
+        elif out.shape != self.out_shape or out.dtype != np.uint8:
+            raise ValueError(f"[!] Буфер результата {out.shape} {out.dtype}, нужен {self.out_shape} uint8")
+
+        gray = image
+        if image.ndim != 2:
+            gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY, dst=self._gray)
+        binary = self._binary
+        if self.selector.mode is ThresholdMode.ADAPTIVE and self._adaptive is None:
+            shape = self._frame_shape[:2]
+            self._adaptive = (self._buffer(shape, np.float32), self._buffer(shape, np.float32))
+        self.selector.apply(gray, threshold_value, dst=binary, buffers=self._adaptive)
+
+        if self.coarse_factor > 1:
+            bounds = self._coarse_bounds(binary)
+        else:
+            bounds = self._exact_bounds(binary, self._rows, self._cols)
+        if bounds is None:
+            raise ValueError("[!] На изображении нет пикселей со значением 255")
+        top, down, left, right = bounds
+        cv.resize(binary[top + self.top_offset:down, left:right], (out.shape[1], out.shape[0]),
+                  dst=out, interpolation=cv.INTER_AREA)
+        return out
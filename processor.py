@@ -1,7 +1,22 @@
 import cv2 as cv
 import numpy as np
+from enum import Enum
 from typing import List, Tuple, Optional
-from model import Color, Group, GroupPack
+from model import Color, ArrayGroupPack, PointArray, BlobSet
+from thresholding import ThresholdMode, ThresholdSelector
+
+# Для INTER_AREA с целым коэффициентом блок f*f с одним пикселем 255 дает
+# среднее не меньше 1 только при f <= 15, иначе грубый проход может его потерять
+_MAX_COARSE_FACTOR = 15
+
+
+class CentroidEngine(Enum):
+    """
+    HULL - среднее вершин выпуклой оболочки в целых координатах (прежний способ),
+    MOMENTS - центр масс пятна в дробных координатах по connectedComponentsWithStats
+    """
+    HULL = "hull"
+    MOMENTS = "moments"
 
 
 def entire(val1: float, val2: float) -> bool:
@@ -10,29 +25,90 @@ def entire(val1: float, val2: float) -> bool:
     return val1 // val2 == val1 / val2
 
 
+def _axis_bounds(flags: np.ndarray) -> Optional[Tuple[int, int]]:
+    nonzero = np.flatnonzero(flags)
+    if not nonzero.size:
+        return None
+    return int(nonzero[0]), int(nonzero[-1]) + 1
+
+
 class ImageProcessor:
     @staticmethod
     def gray(image: np.ndarray) -> np.ndarray:
         return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
 
     @staticmethod
-    def threshold(image: np.ndarray, on_value=50) -> np.ndarray:
-        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-        _, threshold = cv.threshold(image, on_value, 255, 0)
-        return threshold
+    def rgba_texture(image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        BGR/BGRA/Gray -> плоский буфер RGBA float32 в диапазоне [0, 1]
+        out: готовый буфер размера h * w * 4, заполняется на месте
+        """
+        if image.ndim == 2:
+            code = cv.COLOR_GRAY2RGBA
+        elif image.shape[2] == 4:
+            code = cv.COLOR_BGRA2RGBA
+        else:
+            code = cv.COLOR_BGR2RGBA
+        rgba = cv.cvtColor(image, code)
+        if out is not None:
+            np.multiply(rgba.reshape(-1), np.float32(1 / 255), out=out)
+            return out
+        texture = rgba.astype(np.float32).reshape(-1)
+        texture *= 1 / 255
+        return texture
+
+    @staticmethod
+    def threshold(image: np.ndarray, on_value=50, mode: ThresholdMode = ThresholdMode.MANUAL) -> np.ndarray:
+        """
+        Бинаризация, on_value используется только в MANUAL. Без состояния
+        CACHED равен OTSU, для кэша между кадрами нужен ThresholdSelector
+        """
+        if image.ndim != 2:
+            image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        return ThresholdSelector(mode, on_value).apply(image)
 
     @staticmethod
-    def hull_points(image: np.ndarray) -> GroupPack:
+    def hull_points(image: np.ndarray) -> ArrayGroupPack:
         if len(image.shape) != 2:
             raise AttributeError("Изображение неверного формата")
-        groups = []
         contours, hierarchy = cv.findContours(
             image, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
-        for cnt in contours:
-            hull: np.ndarray = cv.convexHull(cnt, returnPoints=True)
-            hull = hull.squeeze(1)
-            groups.append(Group(hull))
-        return GroupPack(groups)
+        hulls = [cv.convexHull(cnt, returnPoints=True) for cnt in contours]
+        return ArrayGroupPack(PointArray.from_hulls(hulls))
+
+    @staticmethod
+    def blob_set(image: np.ndarray, min_area: int = 0, max_area: Optional[int] = None) -> BlobSet:
+        """
+        Метки, площади, рамки и центры масс всех пятен за один вызов OpenCV,
+        связность 8, как у findContours. Пятна вне [min_area, max_area] отбрасываются
+        """
+        if len(image.shape) != 2:
+            raise AttributeError("Изображение неверного формата")
+        count, labels, stats, centroids = cv.connectedComponentsWithStats(image, connectivity=8)
+        blobs = BlobSet(labels, np.arange(1, count), stats[1:, cv.CC_STAT_AREA],
+                        stats[1:, :cv.CC_STAT_AREA], centroids[1:])
+        return blobs.filter(min_area, max_area)
+
+    @staticmethod
+    def hull_array(image: np.ndarray, min_area: int = 0, max_area: Optional[int] = None) -> PointArray:
+        """
+        Выпуклые оболочки пятен с площадью в [min_area, max_area]; без
+        пределов - как hull_points, с ними пятна отбираются через blob_set
+        """
+        if min_area <= 0 and max_area is None:
+            return ImageProcessor.hull_points(image).point_array
+        return ImageProcessor.blob_set(image, min_area, max_area).hulls
+
+    @staticmethod
+    def blob_centers(image: np.ndarray, engine: CentroidEngine = CentroidEngine.HULL,
+                     min_area: int = 0, max_area: Optional[int] = None) -> np.ndarray:
+        """
+        Центры пятен (N, 2): целые для HULL, дробные для MOMENTS
+        Пятна вне [min_area, max_area] отбрасываются в обоих способах
+        """
+        if engine is CentroidEngine.MOMENTS:
+            return ImageProcessor.blob_set(image, min_area, max_area).centroids
+        return ImageProcessor.hull_array(image, min_area, max_area).centers()
 
     @staticmethod
     def draw_points(image: np.ndarray, *points, **settings) -> None:
@@ -42,46 +118,87 @@ class ImageProcessor:
         for point in points:
             cv.circle(image, point, thickness, color, -1)
 
+    @staticmethod
+    def _exact_crop_bounds(mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        rows = _axis_bounds(mask.any(axis=1))
+        if rows is None:
+            return None
+        cols = _axis_bounds(mask.any(axis=0))
+        return rows[0], rows[1], cols[0], cols[1]
+
+    @staticmethod
+    def _coarse_crop_bounds(mask: np.ndarray, factor: int) -> Optional[Tuple[int, int, int, int]]:
+        factor = min(factor, _MAX_COARSE_FACTOR)
+        dim_h, dim_w = mask.shape
+        main_h, main_w = dim_h // factor * factor, dim_w // factor * factor
+        if not main_h or not main_w:
+            return ImageProcessor._exact_crop_bounds(mask)
+
+        candidates = []
+        main = mask[:main_h, :main_w]
+        small = cv.resize(main, (main_w // factor, main_h // factor), interpolation=cv.INTER_AREA)
+        coarse = ImageProcessor._exact_crop_bounds(small)
+        if coarse is not None:
+            # Точная граница лежит внутри крайнего непустого блока,
+            # поэтому построчно сканируется только полоса шириной factor
+            top, down, left, right = (bound * factor for bound in coarse)
+            top += _axis_bounds(main[top:top + factor].any(axis=1))[0]
+            down -= factor - _axis_bounds(main[down - factor:down].any(axis=1))[1]
+            left += _axis_bounds(main[:, left:left + factor].any(axis=0))[0]
+            right -= factor - _axis_bounds(main[:, right - factor:right].any(axis=0))[1]
+            candidates.append((top, down, left, right))
+
+        # Остатки, не вошедшие в целые блоки, проверяются точно
+        if main_h < dim_h:
+            strip = ImageProcessor._exact_crop_bounds(mask[main_h:])
+            if strip is not None:
+                candidates.append((strip[0] + main_h, strip[1] + main_h, strip[2], strip[3]))
+        if main_w < dim_w:
+            strip = ImageProcessor._exact_crop_bounds(mask[:, main_w:])
+            if strip is not None:
+                candidates.append((strip[0], strip[1], strip[2] + main_w, strip[3] + main_w))
+
+        if not candidates:
+            return None
+        tops, downs, lefts, rights = zip(*candidates)
+        return min(tops), max(downs), min(lefts), max(rights)
+
+    @staticmethod
+    def crop_bounds(image: np.ndarray, on_value=255, coarse_factor: int = 1) -> Tuple[int, int, int, int]:
+        """
+        Границы области с пикселями on_value: top, down, left, right
+
+        down и right не включаются в область. При coarse_factor > 1 сначала
+        ищутся крайние непустые блоки на уменьшенной маске, затем точные
+        границы только внутри них.
+        """
+        mask = cv.compare(image, on_value, cv.CMP_EQ)
+        if coarse_factor > 1:
+            bounds = ImageProcessor._coarse_crop_bounds(mask, coarse_factor)
+        else:
+            bounds = ImageProcessor._exact_crop_bounds(mask)
+        if bounds is None:
+            raise ValueError(f"[!] На изображении нет пикселей со значением {on_value}")
+        return bounds
+
     @staticmethod
     def _crop_vertical(image: np.ndarray, on_value=255, **add) -> Tuple[int, int]:
-        left, right = None, None
-        dim_h, dim_w = image.shape
-        image = list(zip(*image))
-        for i, row in enumerate(image):
-            if on_value in row:
-                left = i
-                break
-        for i, row in enumerate(image[::-1]):
-            if on_value in row:
-                right = dim_w - i
-                break
+        _, _, left, right = ImageProcessor.crop_bounds(image, on_value, add.get("coarse_factor", 1))
         first_add = add.get("first", 0)
         second_add = add.get("second", 0)
         return int(left + first_add), int(right + second_add)
 
     @staticmethod
     def _crop_horizontal(image: np.ndarray, on_value=255, **add) -> Tuple[int, int]:
-        top, down = None, None
-        dim_h, dim_w = image.shape
-        for i, row in enumerate(image):
-            if on_value in row:
-                top = i
-                break
-        for i, row in enumerate(image[::-1]):
-            if on_value in row:
-                down = dim_h - i
-                break
+        top, down, _, _ = ImageProcessor.crop_bounds(image, on_value, add.get("coarse_factor", 1))
         first_add = add.get("first", 0)
         second_add = add.get("second", 0)
         return int(top + first_add), int(down + second_add)
 
     @staticmethod
-    def crop(image: np.ndarray, top_crop: int = 0) -> np.ndarray:
-        one = ImageProcessor._crop_horizontal(image, first=top_crop)
-        two = ImageProcessor._crop_vertical(image)
-        one, two = (two[0], one[0]), (two[1], one[1])
-        image = image[one[1]:two[1], one[0]:two[0]]
-        return image
+    def crop(image: np.ndarray, top_crop: int = 0, coarse_factor: int = 1) -> np.ndarray:
+        top, down, left, right = ImageProcessor.crop_bounds(image, coarse_factor=coarse_factor)
+        return image[top + top_crop:down, left:right]
 
     @staticmethod
     def resize(image: np.ndarray, width: int, height: int, interpolation: Optional[int] = None) -> np.ndarray:
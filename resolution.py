@@ -0,0 +1,63 @@
+from typing import Tuple
+
+from settings import RasterSettings
+
+
+class ResolutionPolicy:
+    """ Выбор рабочего размера (ширина, высота), в котором Analizator ищет пятна муара """
+
+    def size(self, raster_shape: Tuple[int, ...]) -> Tuple[int, int]:
+        raise NotImplementedError
+
+
+class FixedResolution(ResolutionPolicy):
+    """ Всегда один размер, прежнее поведение Analizator - 1000x1000 """
+
+    def __init__(self, width: int = 1000, height: int = 1000):
+        self.width = width
+        self.height = height
+
+    def size(self, raster_shape: Tuple[int, ...]) -> Tuple[int, int]:
+        return self.width, self.height
+
+
+class RasterResolution(ResolutionPolicy):
+    """
+    Размер по параметрам растра: масштаб подбирается так, чтобы на период
+    полос приходилось около period_pixels пикселей, а полоса оставалась не
+    тоньше min_thickness. Грубые растры уменьшаются, тонкие - увеличиваются,
+    пропорции растра сохраняются.
+    """
+
+    def __init__(self, raster_settings: RasterSettings, period_pixels: float = 20, min_thickness: float = 3,
+                 min_scale: float = 0.25, max_scale: float = 2.0):
+        self.raster_settings = raster_settings
+        self.period_pixels = period_pixels
+        self.min_thickness = min_thickness
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+
+    @property
+    def scale(self) -> float:
+        scale = max(self.period_pixels / self.raster_settings.distance,
+                    self.min_thickness / self.raster_settings.thickness)
+        return min(max(scale, self.min_scale), self.max_scale)
+
+    def size(self, raster_shape: Tuple[int, ...]) -> Tuple[int, int]:
+        height, width = raster_shape[:2]
+        return max(round(width * self.scale), 1), max(round(height * self.scale), 1)
+
+
+class ScaledResolution(ResolutionPolicy):
+    """ Размер другой политики, умноженный на factor, для грубого прохода """
+
+    def __init__(self, policy: ResolutionPolicy, factor: float):
+        self.policy = policy
+        self.factor = factor
+
+    def size(self, raster_shape: Tuple[int, ...]) -> Tuple[int, int]:
+        width, height = self.policy.size(raster_shape)
+        return max(round(width * self.factor), 1), max(round(height * self.factor), 1)
+
+
+DEFAULT_RESOLUTION = FixedResolution()
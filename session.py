@@ -0,0 +1,298 @@
+import os
+import threading
+import cv2 as cv
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from image_data import ImageData, SourceType
+from settings import RasterSettings
+from paths import SAVE_DATE_FORMAT, get_config_path_data, read_image
+
+SESSION_EXTENSION = ".mses"
+
+_SESSION_MAGIC = b"MSESSION"
+_SESSION_VERSION = 1
+# Начала индекса и кадров выравниваются, чтобы представления кадров были выровнены
+_ALIGN = 64
+_SETTINGS_BYTES = 128
+
+_HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("capacity", "<u4"), ("count", "<u4"),
+                          ("index_offset", "<u8"), ("data_offset", "<u8"), ("data_bytes", "<u8"),
+                          ("used", "<u8")])
+_INDEX_DTYPE = np.dtype([("offset", "<u8"), ("timestamp", "<f8"), ("source", "u1"), ("channels", "u1"),
+                         ("height", "<u4"), ("width", "<u4"), ("settings", f"S{_SETTINGS_BYTES}")])
+
+
+def _aligned(value: int) -> int:
+    return (value + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _frame_shape(entry) -> Tuple[int, ...]:
+    if entry["channels"]:
+        return int(entry["height"]), int(entry["width"]), int(entry["channels"])
+    return int(entry["height"]), int(entry["width"])
+
+
+class _SessionFile:
+    """ Заголовок и индекс сессии как представления поверх np.memmap всего файла """
+
+    def __init__(self, path: str, mode: str):
+        self.path = str(path)
+        self._mode = mode
+        self._map()
+
+    def _map(self) -> None:
+        self._memmap = np.memmap(self.path, dtype=np.uint8, mode=self._mode)
+        self._header = np.ndarray((1,), _HEADER_DTYPE, buffer=self._memmap)
+        if self._header["magic"][0] != _SESSION_MAGIC or self._header["version"][0] != _SESSION_VERSION:
+            raise ValueError(f"[!] Файл {self.path} не является сессией снимков")
+        self._index = np.ndarray((self.capacity,), _INDEX_DTYPE, buffer=self._memmap,
+                                 offset=int(self._header["index_offset"][0]))
+
+    @property
+    def capacity(self) -> int:
+        return int(self._header["capacity"][0])
+
+    def __len__(self) -> int:
+        return int(self._header["count"][0])
+
+    def _close(self) -> None:
+        self._index = self._header = None
+        self._memmap = None
+
+
+@dataclass
+class SessionFrame:
+    """ Кадр сессии: image_data - представление поверх файла без копирования """
+    index: int
+    image_data: ImageData
+    timestamp: float
+    raster_settings: Optional[RasterSettings]
+
+
+class SessionWriter(_SessionFile):
+    """
+    Запись кадров в один файл сессии
+
+    Если файла нет, он создается с индексом на capacity кадров и областью
+    данных data_bytes, иначе кадры дописываются в существующую сессию.
+    Число кадров в заголовке увеличивается после записи кадра, поэтому
+    читатель не увидит недописанный кадр. Когда область данных кончается,
+    файл увеличивается вдвое, индекс не растет, поэтому по умолчанию
+    область данных небольшая - около шести кадров 720p.
+    """
+
+    def __init__(self, path: str, capacity: int = 1024, data_bytes: int = 1 << 24):
+        if not os.path.exists(path):
+            if capacity < 1 or data_bytes < 0:
+                raise ValueError(f"[!] Неверные размеры сессии: {capacity} кадров, {data_bytes} байт")
+            self._create(path, capacity, data_bytes)
+        self._lock = threading.Lock()
+        super().__init__(path, "r+")
+
+    @staticmethod
+    def _create(path: str, capacity: int, data_bytes: int) -> None:
+        index_offset = _aligned(_HEADER_DTYPE.itemsize)
+        data_offset = _aligned(index_offset + capacity * _INDEX_DTYPE.itemsize)
+        header = np.zeros(1, _HEADER_DTYPE)
+        header[0] = (_SESSION_MAGIC, _SESSION_VERSION, capacity, 0, index_offset, data_offset, data_bytes, 0)
+        with open(path, "wb") as file:
+            file.write(header.tobytes())
+            file.truncate(data_offset + data_bytes)
+
+    def _grow(self, need: int) -> None:
+        data_bytes = max(int(self._header["data_bytes"][0]), _ALIGN)
+        while data_bytes < need:
+            data_bytes *= 2
+        self._header["data_bytes"] = data_bytes
+        size = int(self._header["data_offset"][0]) + data_bytes
+        self._memmap.flush()
+        self._close()
+        with open(self.path, "r+b") as file:
+            file.truncate(size)
+        self._map()
+
+    def append(self, image: np.ndarray, source: SourceType, timestamp: Optional[float] = None,
+               raster_settings: Optional[RasterSettings] = None) -> int:
+        """ Добавление кадра uint8 (серый или BGR), возвращает его номер в сессии """
+        if image.dtype != np.uint8 or image.ndim not in (2, 3):
+            raise ValueError(f"[!] Кадр сессии должен быть uint8 2D или 3D, передан {image.shape} {image.dtype}")
+        settings = raster_settings.stringify().encode() if raster_settings is not None else b""
+        if len(settings) > _SETTINGS_BYTES:
+            raise ValueError(f"[!] Настройки растра длиннее {_SETTINGS_BYTES} байт")
+
+        with self._lock:
+            count = len(self)
+            if count >= self.capacity:
+                raise ValueError(f"[!] Индекс сессии {self.path} заполнен: {self.capacity} кадров")
+            used = int(self._header["used"][0])
+            end = used + _aligned(image.nbytes)
+            if end > int(self._header["data_bytes"][0]):
+                self._grow(end)
+
+            offset = int(self._header["data_offset"][0]) + used
+            frame = np.ndarray(image.shape, np.uint8, buffer=self._memmap, offset=offset)
+            frame[...] = image
+            channels = image.shape[2] if image.ndim == 3 else 0
+            self._index[count] = (offset, datetime.now().timestamp() if timestamp is None else timestamp,
+                                  int(source), channels, image.shape[0], image.shape[1], settings)
+            self._header["used"] = end
+            self._header["count"] = count + 1
+            return count
+
+    def flush(self) -> None:
+        self._memmap.flush()
+
+    def close(self) -> None:
+        if self._memmap is not None:
+            self.flush()
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SessionReader(_SessionFile):
+    """
+    Чтение сессии через np.memmap: кадры отдаются как представления только
+    для чтения поверх файла, без копирования и декодирования. Число кадров
+    берется на момент открытия.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path, "r")
+        self._count = int(self._header["count"][0])
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._index["timestamp"][:self._count]
+
+    @property
+    def sources(self) -> np.ndarray:
+        return self._index["source"][:self._count]
+
+    def image_data(self, index: int) -> ImageData:
+        if not 0 <= index < self._count:
+            raise IndexError(f"[!] В сессии {self.path} нет кадра {index}")
+        entry = self._index[index]
+        image = np.ndarray(_frame_shape(entry), np.uint8, buffer=self._memmap, offset=int(entry["offset"]))
+        return ImageData(image, SourceType(int(entry["source"])))
+
+    def __getitem__(self, index: int) -> SessionFrame:
+        entry = self._index[index]
+        settings = entry["settings"].decode()
+        return SessionFrame(index, self.image_data(index), float(entry["timestamp"]),
+                            RasterSettings.parse(settings) if settings else None)
+
+    def __iter__(self) -> Iterator[SessionFrame]:
+        for index in range(self._count):
+            yield self[index]
+
+    def captures(self) -> List[int]:
+        """ Номера снимков камеры (исходных и обработанных), растры пропускаются """
+        return [index for index, source in enumerate(self.sources)
+                if source in (SourceType.RAW, SourceType.PROCESSED)]
+
+
+def frame_key(path: str, index: int) -> str:
+    """ Имя кадра сессии для результатов пакетного анализа: путь#номер """
+    return f"{path}#{index}"
+
+
+def split_frame_key(key: str) -> Optional[Tuple[str, int]]:
+    path, _, index = key.rpartition("#")
+    if not path.endswith(SESSION_EXTENSION) or not index.isdigit():
+        return None
+    return path, int(index)
+
+
+def _saved_files(folder: Path, filename: str) -> List[Tuple[float, Path]]:
+    """ Файлы filename-<дата> из папки сохранения, отсортированные по дате в имени """
+    files = []
+    for path in folder.glob(f"{filename}-*"):
+        try:
+            stamp = datetime.strptime(path.stem[len(filename) + 1:], SAVE_DATE_FORMAT)
+        except ValueError:
+            continue
+        files.append((stamp.timestamp(), path))
+    return sorted(files)
+
+
+def _session_image(image: np.ndarray) -> Optional[np.ndarray]:
+    """ Прочитанный файл как кадр сессии: uint8, серый или BGR; None - если привести нельзя """
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    elif image.dtype != np.uint8:
+        return None
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv.cvtColor(image, cv.COLOR_BGRA2BGR)
+    elif image.ndim == 3 and image.shape[2] == 1:
+        image = image[:, :, 0]
+    if image.ndim == 2 or image.ndim == 3 and image.shape[2] == 3:
+        return image
+    return None
+
+
+def import_saved(session_path: str, params_path: Optional[dict] = None) -> int:
+    """
+    Перенос сохраненных растров (с их настройками) и снимков камеры из папок
+    [Paths] в новую сессию session_path, возвращает число кадров
+
+    Снимок камеры с тремя каналами считается исходным (RAW), с одним -
+    обработанным. 16-битные файлы и файлы с альфа-каналом приводятся к
+    uint8 BGR, остальные неподходящие пропускаются. Если перенос прервался,
+    недописанный файл сессии удаляется.
+    """
+    params_path = params_path or get_config_path_data()
+    root = Path(params_path["root"]) / params_path["directory"]
+    rasters = _saved_files(root / params_path["folder_raster"], params_path["raster_filename"])
+    cameras = _saved_files(root / params_path["folder_camera"], params_path["camera_filename"])
+    settings = {timestamp: path for timestamp, path in
+                _saved_files(root / params_path["folder_settings"], params_path["settings_filename"])}
+    files = sorted([(timestamp, path, SourceType.RASTER) for timestamp, path in rasters]
+                   + [(timestamp, path, None) for timestamp, path in cameras], key=lambda item: item[0])
+    if not files:
+        return 0
+    if os.path.exists(session_path):
+        raise FileExistsError(f"[!] Сессия {session_path} уже существует")
+
+    writer = None
+    try:
+        for timestamp, path, source in files:
+            # ANYCOLOR: серый WebP возвращается серым, цветной - BGR, как у PNG
+            image = read_image(str(path), cv.IMREAD_ANYCOLOR | cv.IMREAD_ANYDEPTH)
+            if image is None:
+                print(f"[!] Не удалось прочитать {path}")
+                continue
+            image = _session_image(image)
+            if image is None:
+                print(f"[!] Неподдерживаемый формат кадра {path}, пропущен")
+                continue
+            if source is None:
+                source = SourceType.RAW if image.ndim == 3 else SourceType.PROCESSED
+            raster_settings = None
+            if source is SourceType.RASTER and timestamp in settings:
+                raster_settings = RasterSettings.load(str(settings[timestamp]))
+            if writer is None:
+                # Размер области данных по первому кадру, при нехватке файл увеличится
+                writer = SessionWriter(session_path, len(files), len(files) * _aligned(image.nbytes))
+            writer.append(image, source, timestamp, raster_settings)
+        return len(writer) if writer is not None else 0
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.remove(session_path)
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
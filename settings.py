@@ -24,7 +24,7 @@ class RasterSettings:
     angle: int
     distance: int
     thickness: int
-    offset: int = 0
+    offset: float = 0
     color: Tuple[int, int, int] = Color.White
 
     @classmethod
@@ -38,7 +38,11 @@ class RasterSettings:
         except ...:
             print("[!] Неизвестная ошибка")
             return None
+        return cls.parse(settings)
 
+    @classmethod
+    def parse(cls, settings: str):
+        """ Настройки из строки stringify """
         temp = cls(0, 0, 0)
         try:
             for part in settings.split(";"):
@@ -47,7 +51,7 @@ class RasterSettings:
                     value = eval(value)
                     temp.__setattr__(field, value)
                 else:
-                    temp.__setattr__(field, int(value))
+                    temp.__setattr__(field, float(value) if "." in value else int(value))
         except ...:
             print("[!] Загрузка настроек не удалась")
             return None
@@ -0,0 +1,226 @@
+import math
+import numpy as np
+from typing import Iterable, Tuple, List, Optional
+
+from analysis import Analizator, PERSENTILE_LEVELS, deform_by_persentiles
+
+
+class TDigest:
+    """
+    Потоковый эскиз квантилей (merging t-digest)
+
+    Значения копятся в буфере и периодически сжимаются в центроиды, размер
+    которых ограничен шкалой k1: у хвостов центроиды мелкие, поэтому p99
+    оценивается точнее медианы. Эскизы разных процессов объединяются merge.
+    """
+
+    def __init__(self, compression: float = 100.0):
+        self.compression = compression
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._means = np.empty(0)
+        self._weights = np.empty(0)
+        self._buffer: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._buffered = 0
+
+    def _scale(self, q: np.ndarray) -> np.ndarray:
+        return self.compression / (2 * math.pi) * np.arcsin(2 * q - 1)
+
+    def _push(self, means: np.ndarray, weights: np.ndarray) -> None:
+        self._buffer.append((means, weights))
+        self._buffered += len(means)
+        if self._buffered > 10 * self.compression:
+            self._compress()
+
+    def add(self, values: Iterable[float]) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not values.size:
+            return
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._push(values, np.ones_like(values))
+
+    def merge(self, other: "TDigest") -> None:
+        other._compress()
+        if not other.count:
+            return
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._push(other._means, other._weights)
+
+    def _compress(self) -> None:
+        if not self._buffer:
+            return
+        means = np.concatenate([self._means] + [means for means, _ in self._buffer])
+        weights = np.concatenate([self._weights] + [weights for _, weights in self._buffer])
+        self._buffer = []
+        self._buffered = 0
+
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        left = (np.cumsum(weights) - weights) / total
+        # Точки, попавшие в один единичный интервал шкалы k, сливаются в центроид
+        clusters = np.floor(self._scale(left) - self._scale(np.zeros(1))).astype(np.intp)
+        starts = np.flatnonzero(np.diff(clusters, prepend=-1))
+        self._weights = np.add.reduceat(weights, starts)
+        self._means = np.add.reduceat(means * weights, starts) / self._weights
+
+    def quantile(self, q: float) -> float:
+        """ q в долях: 0.5 - медиана """
+        self._compress()
+        if not self.count:
+            return math.nan
+        positions = np.cumsum(self._weights) - self._weights / 2
+        positions = np.concatenate(([0.0], positions, [self.count]))
+        means = np.concatenate(([self.min], self._means, [self.max]))
+        return float(np.interp(q * self.count, positions, means))
+
+
+class HistogramAccumulator:
+    """ Гистограмма с фиксированными корзинами, значения больше max_value идут в последнюю """
+
+    def __init__(self, bin_width: float = 0.25, max_value: float = 64.0):
+        self.bin_width = bin_width
+        self.max_value = max_value
+        self.bins = int(math.ceil(max_value / bin_width))
+        self.counts = np.zeros(self.bins + 1, dtype=np.int64)
+        self.max = -math.inf
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def add(self, values: Iterable[float]) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not values.size:
+            return
+        indexes = np.minimum((values / self.bin_width).astype(np.intp), self.bins)
+        self.counts += np.bincount(indexes, minlength=self.bins + 1)
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: "HistogramAccumulator") -> None:
+        if (other.bin_width, other.bins) != (self.bin_width, self.bins):
+            raise ValueError("[!] Гистограммы с разными корзинами нельзя объединить")
+        self.counts += other.counts
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        total = self.count
+        if not total:
+            return math.nan
+        cumulative = np.cumsum(self.counts)
+        target = q * total
+        index = int(np.searchsorted(cumulative, target))
+        index = min(index, self.bins)
+        if index == self.bins:
+            return self.max
+        before = cumulative[index] - self.counts[index]
+        share = (target - before) / self.counts[index] if self.counts[index] else 0.0
+        return float((index + share) * self.bin_width)
+
+
+class ValueCounts:
+    """
+    Точные счетчики различных значений
+
+    Расстояния между целочисленными центрами HULL принимают немного
+    различных значений, поэтому их можно хранить без потерь: квантили
+    совпадают с np.percentile по всем значениям. Если различных значений
+    стало больше max_distinct (дробные центры MOMENTS), счетчики
+    сбрасываются и overflow указывает брать эскиз.
+    """
+
+    def __init__(self, max_distinct: int = 1 << 16):
+        self.max_distinct = max_distinct
+        self.overflow = False
+        self.values = np.empty(0)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def _combine(self, values: np.ndarray, counts: np.ndarray) -> None:
+        if self.overflow:
+            return
+        values, inverse = np.unique(np.concatenate((self.values, values)), return_inverse=True)
+        if len(values) > self.max_distinct:
+            self.overflow = True
+            self.values, self.counts = np.empty(0), np.empty(0, dtype=np.int64)
+            return
+        self.values = values
+        self.counts = np.bincount(inverse, weights=np.concatenate((self.counts, counts)),
+                                  minlength=len(values)).astype(np.int64)
+
+    def add(self, values: Iterable[float]) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size:
+            self._combine(*np.unique(values, return_counts=True))
+
+    def merge(self, other: "ValueCounts") -> None:
+        if other.overflow:
+            self.overflow = True
+            self.values, self.counts = np.empty(0), np.empty(0, dtype=np.int64)
+        self._combine(other.values, other.counts)
+
+    def quantile(self, q: float) -> float:
+        """ Линейная интерполяция между соседними по порядку значениями, как у np.percentile """
+        total = self.count
+        if not total:
+            return math.nan
+        position = q * (total - 1)
+        low = math.floor(position)
+        cumulative = np.cumsum(self.counts)
+        below = self.values[np.searchsorted(cumulative, low, side="right")]
+        above = self.values[np.searchsorted(cumulative, min(low + 1, total - 1), side="right")]
+        return float(below + (position - low) * (above - below))
+
+
+class DistanceStatistics:
+    """ Накопленная статистика расстояний по многим кадрам и деталям """
+
+    def __init__(self, compression: float = 100.0, bin_width: float = 0.25, max_value: float = 64.0):
+        self.exact = ValueCounts()
+        self.digest = TDigest(compression)
+        self.histogram = HistogramAccumulator(bin_width, max_value)
+        self.frames = 0
+
+    def add(self, distances: Iterable[float]) -> None:
+        distances = np.asarray(distances, dtype=np.float64)
+        self.exact.add(distances)
+        self.digest.add(distances)
+        self.histogram.add(distances)
+        self.frames += 1
+
+    def update(self, analizator: Analizator) -> None:
+        """ Расстояния кадра в пикселях растра, как и в add """
+        self.add(analizator.distance_values)
+
+    def merge(self, other: "DistanceStatistics") -> None:
+        self.exact.merge(other.exact)
+        self.digest.merge(other.digest)
+        self.histogram.merge(other.histogram)
+        self.frames += other.frames
+
+    def persentiles(self, source: str = "exact") -> Optional[Tuple[float, float, float]]:
+        """
+        p50, p90, p99 по точным счетчикам (exact), эскизу (digest) или
+        гистограмме (histogram); exact при переполнении берет эскиз
+        """
+        sketches = {"exact": self.digest if self.exact.overflow else self.exact,
+                    "digest": self.digest,
+                    "histogram": self.histogram}
+        sketch = sketches[source]
+        if not sketch.count:
+            return None
+        return tuple(sketch.quantile(persent / 100) for persent in PERSENTILE_LEVELS)
+
+    def has_deform(self, source: str = "exact") -> bool:
+        persentiles = self.persentiles(source)
+        if persentiles is None:
+            return False
+        return deform_by_persentiles(persentiles[0], persentiles[2])
@@ -0,0 +1,182 @@
+import cv2 as cv
+import numpy as np
+from typing import List, Tuple, Dict, Optional
+
+from model import Point, points_from_array
+from image_data import ImageData
+from processor import ImageProcessor, CentroidEngine
+from matching import NearestMatcher
+
+RowRange = Tuple[int, List[float]]
+
+
+def _row_levels(y_points: np.ndarray) -> np.ndarray:
+    """
+    Уровни строк шаблона. Дробные центры одной строки расходятся из-за сетки
+    пикселей и обрезанных краем пятен, поэтому значения ближе четверти
+    типичного шага строк сливаются в один уровень
+    """
+    y_points = np.unique(y_points)
+    if not np.issubdtype(y_points.dtype, np.floating) or len(y_points) < 2:
+        return y_points
+    gaps = np.diff(y_points)
+    steps = gaps[gaps > 1]
+    tolerance = 0.25 * float(np.median(steps)) if len(steps) else 1.0
+    starts = np.flatnonzero(np.diff(y_points, prepend=-np.inf) > tolerance)
+    return np.add.reduceat(y_points, starts) / np.diff(np.append(starts, len(y_points)))
+
+
+def row_ranges(centers: np.ndarray) -> List[RowRange]:
+    """ Полосы строк шаблона [y - h/2, y + h/2), нумерация с 1 """
+    y_points = _row_levels(centers[:, 1]).tolist()
+    h_half = (y_points[1] - y_points[0]) / 2
+    return [(i, [y_co - h_half, y_co + h_half])
+            for i, y_co in enumerate(y_points, start=1)]
+
+
+def scale_raster(image: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Растр в размере size (ширина, высота) той же интерполяцией, что и
+    обработанный снимок в Analizator, чтобы пятна шаблона и муара совпадали
+    """
+    width, height = size
+    if image.shape[:2] == (height, width):
+        return image
+    return ImageProcessor.resize(image, width, height, interpolation=cv.INTER_AREA)
+
+
+class RowGroups:
+    """
+    Точки, разложенные по полосам строк
+
+    indexes хранит индексы точек подряд по строкам (внутри строки в исходном
+    порядке), строка row занимает indexes[offsets[row]:offsets[row + 1]].
+    """
+
+    def __init__(self, indexes: np.ndarray, offsets: np.ndarray):
+        self.indexes = indexes
+        self.offsets = offsets
+
+    def __getitem__(self, row: int) -> np.ndarray:
+        if row < 0 or row + 1 >= len(self.offsets):
+            return self.indexes[:0]
+        return self.indexes[self.offsets[row]:self.offsets[row + 1]]
+
+    def keys(self) -> List[int]:
+        return np.flatnonzero(np.diff(self.offsets)).tolist()
+
+    @property
+    def max_row(self) -> int:
+        rows = self.keys()
+        return rows[-1] if rows else 0
+
+
+def assign_rows(ranges: List[RowRange], y_points: np.ndarray) -> RowGroups:
+    """
+    Раскладывает точки по полосам [low, high), точка попадает во все полосы,
+    которые ее содержат
+
+    Полосы одной ширины отсортированы, поэтому подходящие строки образуют
+    непрерывный отрезок: его границы находятся двумя np.searchsorted.
+    """
+    lows = np.array([row[1][0] for row in ranges], dtype=np.float64)
+    highs = np.array([row[1][1] for row in ranges], dtype=np.float64)
+    y_points = np.asarray(y_points)
+    first = np.searchsorted(highs, y_points, side="right")
+    last = np.searchsorted(lows, y_points, side="right")
+    counts = np.maximum(last - first, 0)
+
+    point_indexes = np.repeat(np.arange(len(y_points)), counts)
+    inner = np.arange(len(point_indexes)) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(first, counts) + inner + 1
+    order = np.argsort(rows, kind="stable")
+
+    offsets = np.zeros(len(ranges) + 2, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=len(ranges) + 1), out=offsets[1:])
+    return RowGroups(point_indexes[order], offsets)
+
+
+class TemplateModel:
+    """
+    Все, что зависит только от пары растров: изображение шаблона, маска,
+    центры шаблона, полосы строк и индексы поиска ближайшего центра
+
+    Строится один раз на партию и сохраняется в .npz рядом с растрами.
+    """
+
+    def __init__(self, template_image: np.ndarray, mask: np.ndarray, centers: np.ndarray,
+                 centroids: CentroidEngine = CentroidEngine.HULL):
+        self.template_image = template_image
+        self.mask = mask
+        self.centers = centers
+        self.centroids = centroids
+        self.row_ranges = row_ranges(centers)
+        self._points: Optional[List[Point]] = None
+        self._row_groups: Optional[RowGroups] = None
+        self._row_matchers: Dict[int, NearestMatcher] = {}
+        self._matcher: Optional[NearestMatcher] = None
+
+    @classmethod
+    def build(cls, base_raster: ImageData, over_raster: ImageData, size: Optional[Tuple[int, int]] = None,
+              centroids: CentroidEngine = CentroidEngine.HULL):
+        """
+        size: рабочий размер (ширина, высота), по умолчанию размер растров
+        centroids: способ поиска центров пятен шаблона
+        """
+        mask = over_raster.image
+        if mask.ndim != 2:
+            mask = ImageProcessor.gray(mask)
+        base = base_raster.image
+        if size is not None:
+            mask = scale_raster(mask, size)
+            base = scale_raster(base, size)
+        template = ImageProcessor.masking(base, mask)
+        centers = ImageProcessor.blob_centers(template, centroids)
+        return cls(template, mask, centers, centroids)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.mask.shape
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """ Рабочий размер (ширина, высота), под который построена модель """
+        return self.mask.shape[1], self.mask.shape[0]
+
+    @property
+    def points(self) -> List[Point]:
+        if self._points is None:
+            self._points = points_from_array(self.centers)
+        return self._points
+
+    @property
+    def row_groups(self) -> RowGroups:
+        if self._row_groups is None:
+            self._row_groups = assign_rows(self.row_ranges, self.centers[:, 1])
+        return self._row_groups
+
+    def row_matcher(self, row: int) -> NearestMatcher:
+        matcher = self._row_matchers.get(row)
+        if matcher is None:
+            matcher = NearestMatcher(self.centers[self.row_groups[row]])
+            self._row_matchers[row] = matcher
+        return matcher
+
+    @property
+    def matcher(self) -> NearestMatcher:
+        if self._matcher is None:
+            self._matcher = NearestMatcher(self.centers)
+        return self._matcher
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, template_image=self.template_image, mask=self.mask, centers=self.centers,
+                            centroids=self.centroids.value, size=np.array(self.size))
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            centroids = CentroidEngine(str(data["centroids"])) if "centroids" in data else CentroidEngine.HULL
+            model = cls(data["template_image"], data["mask"], data["centers"], centroids)
+            if "size" in data and tuple(int(value) for value in data["size"]) != model.size:
+                raise ValueError(f"[!] Размер модели шаблона {tuple(data['size'])} не совпадает с маской {model.size}")
+            return model
@@ -0,0 +1,124 @@
+import cv2 as cv
+import numpy as np
+from enum import Enum
+from typing import Optional, Tuple
+
+
+class ThresholdMode(Enum):
+    """
+    MANUAL - порог задан оператором, OTSU - порог Оцу по всему кадру,
+    ADAPTIVE - порог Оцу по плиткам с плавной интерполяцией между ними,
+    CACHED - порог предыдущего кадра, пока гистограмма не сместилась
+    """
+    MANUAL = "manual"
+    OTSU = "otsu"
+    ADAPTIVE = "adaptive"
+    CACHED = "cached"
+
+
+# Плитки с меньшим разбросом яркости считаются однородными, порог Оцу для них
+# не имеет смысла и берется общий порог кадра
+_MIN_TILE_STD = 8.0
+
+
+def histogram(gray: np.ndarray) -> np.ndarray:
+    """ Гистограмма яркости на 256 корзин """
+    return cv.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+
+
+def otsu_value(hist: np.ndarray) -> int:
+    """ Порог Оцу по гистограмме: пиксели больше порога становятся 255, как у cv.THRESH_OTSU """
+    total = hist.sum()
+    if not total:
+        return 0
+    levels = np.arange(len(hist), dtype=np.float64)
+    omega = np.cumsum(hist) / total
+    mu = np.cumsum(hist * levels) / total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    between = np.nan_to_num(between, nan=-1.0, posinf=-1.0)
+    return int(np.argmax(between))
+
+
+def _axis_edges(size: int, parts: int) -> np.ndarray:
+    return np.linspace(0, size, parts + 1).astype(np.intp)
+
+
+def tile_thresholds(gray: np.ndarray, grid: Tuple[int, int] = (4, 4)) -> np.ndarray:
+    """ Пороги Оцу по плиткам сетки (строки, столбцы), однородные плитки получают общий порог """
+    rows, cols = grid
+    y_edges = _axis_edges(gray.shape[0], rows)
+    x_edges = _axis_edges(gray.shape[1], cols)
+    common = otsu_value(histogram(gray))
+    thresholds = np.full(grid, common, dtype=np.float32)
+    for row in range(rows):
+        for col in range(cols):
+            tile = gray[y_edges[row]:y_edges[row + 1], x_edges[col]:x_edges[col + 1]]
+            _, std = cv.meanStdDev(tile)
+            if tile.size and std[0, 0] >= _MIN_TILE_STD:
+                thresholds[row, col] = otsu_value(histogram(tile))
+    return thresholds
+
+
+def histogram_drift(hist: np.ndarray, reference: np.ndarray) -> float:
+    """ Доля пикселей, сменивших корзину: половина суммы модулей разностей нормированных гистограмм """
+    return 0.5 * float(np.abs(hist / hist.sum() - reference / reference.sum()).sum())
+
+
+class ThresholdSelector:
+    """
+    Выбор порога бинаризации кадра в заданном режиме
+
+    value - порог, выбранный на последнем кадре (для ADAPTIVE - медиана
+    порогов плиток), его показывает интерфейс. В режиме CACHED порог Оцу
+    пересчитывается, только если гистограмма сместилась больше чем на drift
+    относительно кадра, на котором порог считался, recomputed - число пересчетов.
+    """
+
+    def __init__(self, mode: ThresholdMode = ThresholdMode.MANUAL, value: int = 100,
+                 grid: Tuple[int, int] = (4, 4), drift: float = 0.1):
+        self.mode = mode
+        self.value = value
+        self.grid = grid
+        self.drift = drift
+        self.recomputed = 0
+        self._reference: Optional[np.ndarray] = None
+
+    def reset(self) -> None:
+        self._reference = None
+
+    def _cached_value(self, gray: np.ndarray) -> int:
+        hist = histogram(gray)
+        if self._reference is None or histogram_drift(hist, self._reference) > self.drift:
+            self._reference = hist
+            self.value = otsu_value(hist)
+            self.recomputed += 1
+        return self.value
+
+    def apply(self, gray: np.ndarray, value: Optional[int] = None, dst: Optional[np.ndarray] = None,
+              buffers: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> np.ndarray:
+        """
+        Бинаризация серого кадра, value используется только в MANUAL
+
+        buffers: два буфера float32 размера кадра для ADAPTIVE (копия кадра
+        и карта порогов), без них они выделяются на каждый кадр
+        """
+        if self.mode is ThresholdMode.ADAPTIVE:
+            thresholds = tile_thresholds(gray, self.grid)
+            self.value = int(np.median(thresholds))
+            gray_float, threshold_map = buffers if buffers is not None else (None, None)
+            if gray_float is None:
+                gray_float = gray.astype(np.float32)
+            else:
+                np.copyto(gray_float, gray)
+            threshold_map = cv.resize(thresholds, (gray.shape[1], gray.shape[0]), dst=threshold_map,
+                                      interpolation=cv.INTER_LINEAR)
+            return cv.compare(gray_float, threshold_map, cv.CMP_GT, dst=dst)
+
+        if self.mode is ThresholdMode.OTSU:
+            self.value = otsu_value(histogram(gray))
+        elif self.mode is ThresholdMode.CACHED:
+            self._cached_value(gray)
+        elif value is not None:
+            self.value = value
+        return cv.threshold(gray, self.value, 255, cv.THRESH_BINARY, dst=dst)[1]
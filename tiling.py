@@ -0,0 +1,183 @@
+import os
+import cv2 as cv
+import numpy as np
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from model import Color
+from image_data import ImageData
+from processor import ImageProcessor, CentroidEngine
+from template import TemplateModel
+from resolution import ResolutionPolicy, DEFAULT_RESOLUTION
+from analysis import Analizator, PERSENTILE_LEVELS, deform_by_persentiles
+
+
+@dataclass
+class Tile:
+    """
+    Прямоугольник сетки: core - своя область без перекрытия,
+    bounds - область с перекрытием, в которой ищутся пятна муара,
+    claim - область, центры в которой относятся к плитке: у края
+    изображения она не ограничена, центр пятна может лежать за краем
+    Границы заданы как (top, down, left, right), down и right не включаются
+    """
+    row: int
+    col: int
+    core: Tuple[int, int, int, int]
+    bounds: Tuple[int, int, int, int]
+    claim: Tuple[float, float, float, float]
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        top, down, left, right = self.claim
+        return ((points[:, 1] >= top) & (points[:, 1] < down)
+                & (points[:, 0] >= left) & (points[:, 0] < right))
+
+
+def _axis_edges(size: int, parts: int) -> List[int]:
+    return [size * i // parts for i in range(parts + 1)]
+
+
+def split_tiles(shape: Tuple[int, int], grid: Tuple[int, int] = (4, 4), overlap: int = 32) -> List[Tile]:
+    """ Делит изображение на сетку grid (строки, столбцы), каждая плитка расширена на overlap """
+    height, width = shape[:2]
+    rows, cols = grid
+    if rows < 1 or cols < 1:
+        raise ValueError(f"[!] Неверная сетка плиток {grid}")
+    y_edges = _axis_edges(height, rows)
+    x_edges = _axis_edges(width, cols)
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            top, down = y_edges[row], y_edges[row + 1]
+            left, right = x_edges[col], x_edges[col + 1]
+            bounds = (max(top - overlap, 0), min(down + overlap, height),
+                      max(left - overlap, 0), min(right + overlap, width))
+            claim = (top if row else -np.inf, down if row < rows - 1 else np.inf,
+                     left if col else -np.inf, right if col < cols - 1 else np.inf)
+            tiles.append(Tile(row, col, (top, down, left, right), bounds, claim))
+    return tiles
+
+
+def _tile_blobs(image: np.ndarray, engine: CentroidEngine, min_area: int = 0,
+                max_area: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Центры пятен и углы их рамок (левый верхний и правый нижний включительно) """
+    if engine is CentroidEngine.MOMENTS:
+        blobs = ImageProcessor.blob_set(image, min_area, max_area)
+        return blobs.centroids, blobs.boxes[:, :2], blobs.boxes[:, :2] + blobs.boxes[:, 2:] - 1
+    point_array = ImageProcessor.hull_array(image, min_area, max_area)
+    if not len(point_array):
+        empty = np.empty((0, 2), dtype=np.int64)
+        return empty, empty, empty
+    starts = point_array.offsets[:-1]
+    return (point_array.centers(),
+            np.minimum.reduceat(point_array.coords, starts, axis=0),
+            np.maximum.reduceat(point_array.coords, starts, axis=0))
+
+
+def tile_centers(muar: np.ndarray, tile: Tile, engine: CentroidEngine = CentroidEngine.HULL,
+                 min_area: int = 0, max_area: Optional[int] = None) -> np.ndarray:
+    """
+    Центры пятен муара, принадлежащих плитке
+
+    Пятна, касающиеся края области с перекрытием (кроме края изображения),
+    обрезаны и отбрасываются: их целиком видит соседняя плитка. Из
+    оставшихся берутся те, чей центр лежит в своей области плитки, поэтому
+    каждое пятно учитывается ровно один раз, если перекрытие больше пятна.
+    """
+    top, down, left, right = tile.bounds
+    centers, low, high = _tile_blobs(np.ascontiguousarray(muar[top:down, left:right]), engine,
+                                    min_area, max_area)
+    height, width = muar.shape[:2]
+    cut = np.zeros(len(centers), dtype=bool)
+    if left > 0:
+        cut |= low[:, 0] == 0
+    if top > 0:
+        cut |= low[:, 1] == 0
+    if right < width:
+        cut |= high[:, 0] == right - left - 1
+    if down < height:
+        cut |= high[:, 1] == down - top - 1
+
+    centers = centers[~cut] + (left, top)
+    return centers[tile.contains(centers)]
+
+
+class TiledAnalizator(Analizator):
+    """
+    Analizator, который ищет пятна муара по плиткам в нескольких потоках
+
+    Общий вердикт совпадает с обычным Analizator: плитки дают тот же набор
+    центров муара, а поиск ближайших центров шаблона идет по общей модели
+    шаблона. Дополнительно считаются перцентили по каждой плитке
+    (tile_persentiles), чтобы показать, где именно деформация.
+
+    grid: число плиток по вертикали и горизонтали
+    overlap: перекрытие плиток в пикселях, должно быть больше пятна муара
+    workers: число потоков, по умолчанию по числу ядер
+    """
+
+    def __init__(self, base_raster: ImageData, over_raster: ImageData, processed_image: ImageData,
+                 restrict_rows: bool = True, template_model: Optional[TemplateModel] = None,
+                 resolution: ResolutionPolicy = DEFAULT_RESOLUTION, grid: Tuple[int, int] = (4, 4),
+                 overlap: int = 32, workers: Optional[int] = None,
+                 centroids: CentroidEngine = CentroidEngine.HULL, min_blob_area: int = 0,
+                 max_blob_area: Optional[int] = None):
+        self.grid = grid
+        self.overlap = overlap
+        self._workers = workers or os.cpu_count() or 1
+        self.tiles: List[Tile] = []
+        super().__init__(base_raster, over_raster, processed_image, restrict_rows, template_model, resolution,
+                         centroids, min_blob_area, max_blob_area)
+        self._calc_tile_persentiles()
+
+    def _mask_tile(self, muar: np.ndarray, tile: Tile) -> None:
+        # Маска накладывается только на свою область плитки: области не
+        # пересекаются, поэтому потоки пишут в общий muar без блокировок
+        top, down, left, right = tile.core
+        muar[top:down, left:right] = ImageProcessor.masking(
+            self._processed_image.image[top:down, left:right], self._template.mask[top:down, left:right])
+
+    def _extract_muar(self) -> Tuple[np.ndarray, np.ndarray]:
+        image = self._processed_image.image
+        self.tiles = split_tiles(image.shape, self.grid, self.overlap)
+        muar = np.empty_like(image)
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            list(pool.map(lambda tile: self._mask_tile(muar, tile), self.tiles))
+            centers = list(pool.map(lambda tile: tile_centers(muar, tile, self._centroids, *self._blob_area),
+                                       self.tiles))
+        return muar, np.concatenate(centers)
+
+    def _calc_tile_persentiles(self):
+        """ Перцентили расстояний по точкам муара каждой плитки, nan там, где точек нет """
+        rows, cols = self.grid
+        self.tile_persentiles = np.full((rows, cols, len(PERSENTILE_LEVELS)), np.nan)
+        self.tile_counts = np.zeros((rows, cols), dtype=np.intp)
+        distances = self.distance_values
+        if not len(distances):
+            return
+        muar_points = np.array([dist_agg.muar_point.to_tuple() for dist_agg in self.distanses])
+        for tile in self.tiles:
+            tile_distances = distances[tile.contains(muar_points)]
+            self.tile_counts[tile.row, tile.col] = len(tile_distances)
+            if len(tile_distances):
+                self.tile_persentiles[tile.row, tile.col] = np.percentile(tile_distances, PERSENTILE_LEVELS)
+
+    def tile_deform(self) -> np.ndarray:
+        """ Карта плиток с деформацией (rows, cols) """
+        deform = np.zeros(self.grid, dtype=bool)
+        for tile in self.tiles:
+            if self.tile_counts[tile.row, tile.col]:
+                persentiles = self.tile_persentiles[tile.row, tile.col]
+                deform[tile.row, tile.col] = deform_by_persentiles(persentiles[0], persentiles[-1])
+        return deform
+
+    def poster(self, select_persentile90=True, select_tiles=True):
+        poster = super().poster(select_persentile90)
+        if select_tiles:
+            deform = self.tile_deform()
+            for tile in self.tiles:
+                if deform[tile.row, tile.col]:
+                    top, down, left, right = tile.core
+                    cv.rectangle(poster, (left, top), (right - 1, down - 1), Color.Blue, 1)
+        return poster